@@ -3,29 +3,29 @@
 from __future__ import unicode_literals
 
 from collections import Sequence
+from multiprocessing.pool import ThreadPool
 import copy
+import hashlib
+import json
+import math
+import threading
+import time
 
+from django.core.cache import get_cache
 from django.utils import six
 from django.conf import settings
+from django.db import connections
 
 from bgaddr import parse_address
-import remoteecont
+
+from eecont import cache
+from eecont import client
 
 
 ###########
 # Helpers #
 ###########
 
-def _client():
-    parcel_url  = settings.EECONT['login']['parcel_url']
-    password    = settings.EECONT['login']['password']
-    service_url = settings.EECONT['login']['service_url']
-    username    = settings.EECONT['login']['username']
-    econt = remoteecont.RemoteEcontXml(
-        service_url, parcel_url, username, password, remoteecont.CurlTransfer)
-    return econt
-
-
 def _dict_get(d, *args):
     try:
         for k in args:
@@ -36,6 +36,74 @@ def _dict_get(d, *args):
         return None
 
 
+# Parsed addresses, see `_parse_address`.  Tune it through `maxsize`
+# and check its `stats()` to see whether it's big enough.
+address_cache = cache.LRUCache(1024)
+
+
+def _parse_address(address):
+    """Return `bgaddr.parse_address(address)` as a new dict.
+
+    The results are memoized per process by the whitespace-normalized
+    address, stored as immutable tuples.  If
+    `settings.EECONT['address_cache']` is set to a dict with a
+    `backend` cache alias (and optionally a `timeout`), Django's cache
+    framework is consulted on a miss too, so that the results are
+    shared between processes.
+
+    """
+    key = ' '.join(address.split())
+    items = address_cache.get(key)
+    if items is None:
+        conf = settings.EECONT.get('address_cache')
+        shared = get_cache(conf['backend']) if conf else None
+        cache_key = 'eecont:address:{}'.format(
+            hashlib.md5(key.encode('utf-8')).hexdigest())
+        if shared is not None:
+            items = shared.get(cache_key)
+        if items is None:
+            items = tuple(sorted(six.iteritems(parse_address(address))))
+            if shared is not None:
+                shared.set(cache_key, items, conf.get('timeout'))
+        address_cache.set(key, items)
+    return dict(items)
+
+
+_templates = {}
+
+
+def _template(name):
+    """Return the request template `settings.EECONT[name]` (e.g.
+    'loading' or 'system').  It's copied only once per settings
+    object, instead of deep-copying the settings every time.
+
+    The returned dict, and anything nested in it, is shared: hand out
+    `_fresh` copies of the parts that go into a request.
+
+    """
+    src = settings.EECONT[name]
+    cached = _templates.get(name)
+    if cached is None or cached[0] is not src:
+        cached = _templates[name] = (src, copy.deepcopy(src))
+    return cached[1]
+
+
+def _fresh(value):
+    """Return a copy of `value`, a part of a template, that shares no
+    dicts or lists with it.  Much cheaper than `copy.deepcopy`.
+
+    """
+    if isinstance(value, dict):
+        return dict((k, _fresh(v)) for k, v in six.iteritems(value))
+    if isinstance(value, list):
+        return [_fresh(v) for v in value]
+    return value
+
+
+# Built by `_receiver`, `_shipment` and `_services`
+_OWN_SECTIONS = ('receiver', 'shipment', 'services')
+
+
 def _loadings(address, shipment, services=None):
     """Prepare the loadings request parameter.
 
@@ -47,7 +115,7 @@ def _loadings(address, shipment, services=None):
         address = [address]
 
     if services is None:
-        services = [{}]
+        services = [{}] * len(address)
     elif not isinstance(services, Sequence):
         services = [services]
 
@@ -55,12 +123,12 @@ def _loadings(address, shipment, services=None):
     for address_dict, shipment_dict, services_dict in zip(
             address, shipment, services):
 
-        # TODO: Some properties are copied twice...
-        data = copy.deepcopy(settings.EECONT['loading'])
-
-        data['receiver'].update(_receiver(**address_dict))
-        data['shipment'].update(_shipment(**shipment_dict))
-        data['services'].update(_services(**services_dict))
+        data = dict((k, _fresh(v))
+                    for k, v in six.iteritems(_template('loading'))
+                    if k not in _OWN_SECTIONS)
+        data['receiver'] = _receiver(**address_dict)
+        data['shipment'] = _shipment(**shipment_dict)
+        data['services'] = _services(**services_dict)
         ret.append(data)
     return ret
 
@@ -76,11 +144,11 @@ def _receiver(**kwargs):
     address = kwargs.pop('address', '')
     if isinstance(address, six.string_types):
         other = address
-        address = parse_address(address)
+        address = _parse_address(address)
         address['street_other'] = other
 
     # Prepare receiver struct
-    ret = copy.deepcopy(settings.EECONT['loading']['receiver'])
+    ret = _fresh(_template('loading')['receiver'])
     ret.update(kwargs)
     ret.update({
         'street'           : address.get('street', ''),
@@ -107,7 +175,7 @@ def _services(**kwargs):
       1000 Bulgarian stotinki are 10 Bulgarian leva.
 
     """
-    services = copy.deepcopy(settings.EECONT['loading']['services'])
+    services = _fresh(_template('loading')['services'])
 
     payment = int(kwargs.get('payment', 0))
     payment = '{}.{}'.format(payment // 100, payment % 100)
@@ -124,7 +192,7 @@ def _shipment(**kwargs):
     - `weight`
 
     """
-    shipment = copy.deepcopy(settings.EECONT['loading']['shipment'])
+    shipment = _fresh(_template('loading')['shipment'])
     shipment.update(kwargs)
     return shipment
 
@@ -139,11 +207,95 @@ def _system(**kwargs):
     validate
 
     """
-    ret = copy.deepcopy(settings.EECONT['system'])
+    ret = _fresh(_template('system'))
     ret.update(**kwargs)
     return ret
 
 
+###############
+# Quote cache #
+###############
+
+def _normalize(value):
+    return six.text_type(value or '').strip().lower()
+
+
+def _quote_key(address, shipment, services, weight_step):
+    """Return the cache key of a quote and the bucketed weight, or
+    `(None, None)` if the quote can't be cached.
+
+    """
+    if not all(isinstance(x, dict) for x in (address, shipment, services)):
+        # Multiple loadings
+        return None, None
+    try:
+        weight = float(shipment.get('weight', 0))
+    except (TypeError, ValueError):
+        return None, None
+
+    # Round the weight up to its bucket and quote for the bucket
+    # instead, so that the cached price holds for every weight in it
+    weight = math.ceil(weight / weight_step) * weight_step
+
+    parts = [_normalize(address.get(k))
+             for k in ('city', 'post_code', 'office_code')]
+    parts += ['{:g}'.format(weight), int(services.get('payment', 0))]
+    digest = hashlib.md5(json.dumps(parts).encode('utf-8')).hexdigest()
+    return 'eecont:quote:{}'.format(digest), '{:g}'.format(weight)
+
+
+def _refresh_quote(cache, key, ttl, stale, args):
+    """Ask Econt for a quote and cache it, unless it has no price."""
+    quote = _quote(*args)
+    if quote[0] is not None:
+        cache.set(key, {'quote': quote, 'expires': time.time() + ttl},
+                  ttl + stale)
+    return quote
+
+
+def _cached_delivery_info(conf, address, shipment, services):
+    """Serve quotes from Django's cache framework.
+
+    `conf` is a dict with the keys:
+
+    - `backend`: the cache alias to use, 'default' by default.
+    - `timeout`: seconds a quote stays fresh, 1 hour by default.
+    - `stale`: seconds an expired quote may still be served while a
+      background thread fetches a fresh one, 1 day by default.
+    - `weight_step`: size of the weight buckets in kilograms, 0.5 by
+      default.
+
+    """
+    ttl = conf.get('timeout', 60 * 60)
+    stale = conf.get('stale', 24 * 60 * 60)
+    key, weight = _quote_key(address, shipment, services,
+                             conf.get('weight_step', 0.5))
+    if key is None:
+        return _delivery_info(address, shipment, services)
+
+    shipment = dict(shipment, weight=weight)
+    args = (address, shipment, services)
+    cache = get_cache(conf.get('backend', 'default'))
+
+    entry = cache.get(key)
+    if entry is None:
+        return _with_defaults(*_refresh_quote(cache, key, ttl, stale, args))
+
+    # Stale: revalidate in the background, only one thread at a time
+    if entry['expires'] < time.time() and \
+       cache.add('{}:lock'.format(key), 1, ttl):
+        def revalidate():
+            try:
+                _refresh_quote(cache, key, ttl, stale, args)
+            finally:
+                cache.delete('{}:lock'.format(key))
+        thread = threading.Thread(target=revalidate)
+        thread.daemon = True
+        thread.start()
+
+    return _with_defaults(*entry['quote'])
+
+
 ###########
 # Request #
 ###########
@@ -151,7 +303,8 @@ def _system(**kwargs):
 def _generic_request(address, shipment, services=None, system=None):
     loadings = _loadings(address, shipment, services)
     system = _system(**(system or {}))
-    response = _client().shipping(loadings, system)
+    with client.pool().client() as econt:
+        response = econt.shipping(loadings, system)
     return response
 
 
@@ -161,7 +314,62 @@ def shipment_request(address, shipment, services):
     return response
 
 
-def delivery_info(address, shipment, services):
+def _results(response, count):
+    """Return the list of `count` per-loading results in `response`.
+    Econt returns a single <e> element as a dict and many as a list.
+    Missing results are None and extra ones are dropped.
+
+    """
+    results = _dict_get(response, 'result', 'e')
+    if isinstance(results, dict):
+        results = [results]
+    results = list(results or [])[:count]
+    return results + [None] * (count - len(results))
+
+
+def shipment_request_many(orders, chunk_size=50):
+    """Request many shipments with as few round-trips as possible.
+
+    `orders` is a sequence of dicts with the keys `address`,
+    `shipment` and optionally `services`, i.e. the arguments of
+    `shipment_request`.  Up to `chunk_size` loadings are sent per
+    request.
+
+    Return a list of dicts, one per order and in the same order, with
+    the keys `result` (the loading's <e> element) and `error` (None on
+    success).  A failed request marks the orders of its chunk only, so
+    the shipments already created by earlier chunks are never lost.
+
+    """
+    system = {'only_calculate': 0, 'validate': 0}
+    ret = []
+    for i in range(0, len(orders), chunk_size):
+        chunk = orders[i:i + chunk_size]
+        try:
+            response = _generic_request(
+                [o['address'] for o in chunk],
+                [o['shipment'] for o in chunk],
+                [o.get('services') or {} for o in chunk],
+                system)
+        except Exception as e:
+            ret.extend({'result': None, 'error': six.text_type(e)}
+                       for _ in chunk)
+            continue
+
+        for result in _results(response, len(chunk)):
+            if result is None:
+                error = 'Missing result'
+            else:
+                error = _dict_get(result, 'error') or None
+            ret.append({'result': result, 'error': error})
+    return ret
+
+
+def _quote(address, shipment, services):
+    """Ask Econt for the delivery cost (in coins) and date.  Either of
+    them is None if Econt didn't provide it.
+
+    """
     system = {'only_calculate': 1, 'validate': 0}
     response = _generic_request(address, shipment, services, system)
 
@@ -169,13 +377,16 @@ def delivery_info(address, shipment, services):
     try:
         cost = int(round(float(cost) * 100)) # python2 needs int()
     except (TypeError, ValueError):
-        pass
+        cost = None
 
     d = _dict_get(response, 'result', 'e', 'delivery_date')
     if d:
         # TODO: convert to python date
         pass
+    return cost, d
+
 
+def _with_defaults(cost, d):
     cost = cost or settings.EECONT['defaults'].get('delivery_cost')
     d = d or settings.EECONT['defaults'].get('delivery_date')
     return {
@@ -184,11 +395,39 @@ def delivery_info(address, shipment, services):
     }
 
 
+def _delivery_info(address, shipment, services):
+    return _with_defaults(*_quote(address, shipment, services))
+
+
+def delivery_info(address, shipment, services):
+    """Return the delivery `cost` (in coins) and `date` of a shipment.
+
+    If `settings.EECONT['quote_cache']` is set, quotes are cached, see
+    `_cached_delivery_info`.
+
+    """
+    conf = settings.EECONT.get('quote_cache')
+    if conf:
+        return _cached_delivery_info(conf, address, shipment, services)
+    return _delivery_info(address, shipment, services)
+
+
 def validate_address(address):
     """Return None on successful check or an error string (in Bulgarian)
     in case of any validation error.
 
+    The address is checked against the synced City, Quarter and Street
+    tables first (see `eecont.validation`) unless
+    `settings.EECONT['local_validation']` is False.  Econt is asked
+    only if the local data can't decide.
+
     """
+    if settings.EECONT.get('local_validation', True):
+        from eecont import validation
+        decided, error = validation.validate_locally(address)
+        if decided:
+            return error
+
     shipment = {
         'description': 'A dummy package',
         'weight': '1',
@@ -201,3 +440,61 @@ def validate_address(address):
     }
     response = _generic_request(address, shipment, services, system)
     return _dict_get(response, 'result', 'e', 'error')
+
+
+################
+# Non-blocking #
+################
+
+_workers = None
+_workers_lock = threading.Lock()
+
+
+def _submit(func, *args):
+    """Run `func(*args)` on the shared worker pool and return its
+    `AsyncResult`.  The pool is as large as the client pool (see
+    `client.pool`), which bounds the number of requests in flight.
+
+    """
+    global _workers
+    with _workers_lock:
+        if _workers is None:
+            _workers = ThreadPool(client.pool().size)
+    return _workers.apply_async(_run, (func, args))
+
+
+def _run(func, args):
+    try:
+        return func(*args)
+    finally:
+        # The workers outlive any request, don't leak their connections
+        for conn in connections.all():
+            conn.close()
+
+
+def ashipment_request(address, shipment, services):
+    """Non-blocking `shipment_request`.  Return an `AsyncResult`; call
+    its `get()` for the response.
+
+    """
+    return _submit(shipment_request, address, shipment, services)
+
+
+def adelivery_info(address, shipment, services):
+    """Non-blocking `delivery_info`.  Return an `AsyncResult`; call its
+    `get()` for the `{'cost', 'date'}` dict.  Start several of these
+    to quote many carts at once:
+
+        pending = [adelivery_info(a, s, sv) for a, s, sv in carts]
+        quotes = [p.get() for p in pending]
+
+    """
+    return _submit(delivery_info, address, shipment, services)
+
+
+def avalidate_address(address):
+    """Non-blocking `validate_address`.  Return an `AsyncResult`; call
+    its `get()` for the error string or None.
+
+    """
+    return _submit(validate_address, address)
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+
+"""In-memory autocomplete over the names of the synced cities, quarters
+and streets, so that the JSONP views don't query the database on every
+keystroke.
+
+Each model (or, for quarters and streets, each model and city) gets a
+`PrefixIndex` built on first use and dropped by `invalidate` after a
+sync.  Other processes rebuild their indexes once they see a new
+`nomenclature.version`.
+
+"""
+
+from __future__ import unicode_literals
+
+import bisect
+import collections
+import threading
+
+from django.utils import six
+
+from eecont import cache
+from eecont import models
+from eecont import nomenclature
+
+
+def fold(name):
+    return six.text_type(name or '').lower()
+
+
+class PrefixIndex(object):
+    """Sorted array of case-folded Bulgarian and Latin names.  A prefix
+    lookup is a binary search followed by a short scan.
+
+    """
+
+    def __init__(self, names):
+        """`names` is an iterable of `(name, name_en)` pairs, one per
+        row.  Results are always Bulgarian names, counted per row.
+
+        """
+        self.counts = collections.Counter()
+        entries = set()
+        for name, name_en in names:
+            self.counts[name] += 1
+            entries.add((fold(name), name))
+            if name_en:
+                entries.add((fold(name_en), name))
+        entries = sorted(entries)
+        self._keys = [k for k, _ in entries]
+        self._names = [n for _, n in entries]
+
+    def __len__(self):
+        return len(self.counts)
+
+    def search(self, query, limit=10):
+        """Return up to `limit` `{'name', 'count'}` dicts for the names
+        starting with `query`, ordered by their folded form.
+
+        """
+        query = fold(query)
+        ret = []
+        seen = set()
+        i = bisect.bisect_left(self._keys, query)
+        while (i < len(self._keys) and len(ret) < limit
+               and self._keys[i].startswith(query)):
+            name = self._names[i]
+            if name not in seen:
+                seen.add(name)
+                ret.append({'name': name, 'count': self.counts[name]})
+            i += 1
+        return ret
+
+
+_indexes = {}
+_lock = threading.Lock()
+
+# One lock per key, so that a slow build doesn't hold up lookups in the
+# other indexes
+_building = {}
+
+
+def _names(model, city):
+    qs = model.objects.all()
+    if city is not None:
+        # Served by the (city, name) index
+        qs = qs.filter(city_id=city).order_by('name')
+    return qs.values_list('name', 'name_en')
+
+
+def index(model, city=None):
+    """Return the `PrefixIndex` of `model`, limited to the rows of the
+    `city` pk if given.  (Re)build it if needed.
+
+    """
+    key = (model, city)
+    version = nomenclature.version()
+    entry = _indexes.get(key)
+    if entry is not None and entry[1] == version:
+        return entry[0]
+
+    with _lock:
+        building = _building.setdefault(key, threading.Lock())
+    with building:
+        # Somebody else may have built it in the meantime
+        entry = _indexes.get(key)
+        if entry is None or entry[1] != version:
+            entry = (PrefixIndex(_names(model, city).iterator()), version)
+            with _lock:
+                _indexes[key] = entry
+        return entry[0]
+
+
+def search(model, query, limit=10, city=None):
+    return index(model, city).search(query, limit)
+
+
+# (eid, post code) -> city pk
+_cities = cache.LRUCache(8192)
+
+
+def city_id(eid=None, post_code=None):
+    """Return the pk of the city with Econt id `eid` or, if that's not
+    given, with `post_code`.  Return None if there's no such city.
+
+    """
+    key = (eid, post_code)
+    pk = _cities.get(key)
+    if pk is None:
+        field, value = ('eid', eid) if eid else ('post_code', post_code)
+        try:
+            value = int(value)
+        except (TypeError, ValueError):
+            return None
+        pk = models.City.objects.filter(**{field: value})\
+                                .values_list('pk', flat=True).first()
+        if pk is not None:
+            _cities.set(key, pk)
+    return pk
+
+
+def invalidate():
+    """Drop all indexes, they're rebuilt on the next lookup."""
+    with _lock:
+        _indexes.clear()
+    _cities.clear()
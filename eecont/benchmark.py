@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+
+"""Benchmarks of the sync pipeline against synthetic nomenclatures.
+
+The generated records have the same shape as the raw Econt responses
+(see the fixtures in `tests.py`), sized like the production data.
+Every stage is timed on its own: transform, relation resolution,
+database write and the custom fields' conversions.
+
+"""
+
+from __future__ import unicode_literals
+
+import collections
+import copy
+import platform
+import random
+import time
+
+import django
+
+from eecont import fields
+from eecont import inserter
+from eecont import models
+from eecont import transform
+
+
+SIZES = collections.OrderedDict([('zone', 20),
+                                 ('city', 5000),
+                                 ('street', 60000),
+                                 ('office', 2000)])
+
+_SHIPMENTS = ['cargo_expres_shipments', 'cargo_palet_shipments',
+              'courier_shipments', 'post_shipments']
+
+_TIMES = ['08:00:00', '08:30:00', '09:00:00', '09:30:00', '12:00:00',
+          '13:00:00', '17:30:00', '18:00:00', '19:00:00', '24:00:00']
+
+
+def _updated_time(rnd):
+    # Econt data is extremely repetitive, so are the timestamps here
+    return '2013-{:02d}-{:02d} 09:07:09'.format(rnd.randint(1, 12),
+                                                 rnd.randint(1, 28))
+
+
+def _codes(rnd, offices):
+    return [str(c) for c in
+            rnd.sample(offices, min(len(offices), rnd.randint(0, 4)))]
+
+
+def zones(rnd, n):
+    return [{'id': str(i),
+             'is_ee': rnd.choice(['0', '1']),
+             'name': 'Зона №{}'.format(i),
+             'name_en': 'Zone #{}'.format(i),
+             'national': rnd.choice(['0', '1']),
+             'updated_time': _updated_time(rnd)}
+            for i in range(1, n + 1)]
+
+
+def cities(rnd, n, zone_ids, office_codes):
+    ret = []
+    for i in range(1, n + 1):
+        offices = dict(
+            (tag, dict(('{}_{}'.format(seg1, seg2),
+                        {'office_code': _codes(rnd, office_codes)})
+                       for seg1 in ['from', 'to']
+                       for seg2 in ['door', 'office']))
+            for tag in _SHIPMENTS)
+        ret.append({
+            'attach_offices': offices,
+            'id': str(i),
+            'id_country': '1033',
+            'id_office': str(rnd.choice(office_codes)),
+            'id_zone': str(rnd.choice(zone_ids)),
+            'name': 'Град №{}'.format(i),
+            'name_en': 'City #{}'.format(i),
+            'post_code': str(1000 + i),
+            'region': 'Планета Земя',
+            'region_en': 'Planet Earth',
+            'service_days': dict(('day{}'.format(d), rnd.choice('01'))
+                                 for d in range(1, 8)),
+            'type': rnd.choice(['гр.', 'с.']),
+            'updated_time': _updated_time(rnd)})
+    return ret
+
+
+def streets(rnd, n, city_ids):
+    return [{'id': str(i),
+             'name': 'ул. Улица №{}'.format(i),
+             'name_en': 'Street #{}'.format(i),
+             'city_post_code': '1000',
+             'id_city': str(rnd.choice(city_ids)),
+             'updated_time': _updated_time(rnd)}
+            for i in range(1, n + 1)]
+
+
+def offices(rnd, n):
+    return [{'address': 'Град ул. Улица №{}'.format(i),
+             'address_details': {'ap': '', 'bl': '', 'et': '',
+                                 'num': str(i), 'other': '',
+                                 'quarter_name': 'Квартал',
+                                 'street_name': 'ул. Улица',
+                                 'vh': ''},
+             'address_en': 'Grad ul. Ulica #{}'.format(i),
+             'city_name': 'Град',
+             'city_name_en': 'Grad',
+             'id': str(i),
+             'latitude': '42.4821587',
+             'longitude': '26.4996131',
+             'name': 'Офис №{}'.format(i),
+             'name_en': 'Office #{}'.format(i),
+             'office_code': str(1000 + i),
+             'phone': '+359 466 29962',
+             'time_priority': rnd.choice(_TIMES),
+             'updated_time': _updated_time(rnd),
+             'work_begin': rnd.choice(_TIMES),
+             'work_begin_saturday': rnd.choice(_TIMES),
+             'work_end': rnd.choice(_TIMES),
+             'work_end_saturday': rnd.choice(_TIMES)}
+            for i in range(1, n + 1)]
+
+
+def _sizes(sizes):
+    ret = dict(SIZES)
+    ret.update(sizes or {})
+    return ret
+
+
+def generate(sizes=None, seed=0):
+    """Return an `OrderedDict` of raw nomenclatures, in insert order."""
+    sizes = _sizes(sizes)
+    rnd = random.Random(seed)
+    office_codes = list(range(1001, 1001 + sizes['office']))
+    zone_ids = list(range(1, sizes['zone'] + 1))
+    city_ids = list(range(1, sizes['city'] + 1))
+    return collections.OrderedDict([
+        ('zone', zones(rnd, sizes['zone'])),
+        ('city', cities(rnd, sizes['city'], zone_ids, office_codes)),
+        ('street', streets(rnd, sizes['street'], city_ids)),
+        ('office', offices(rnd, sizes['office']))])
+
+
+def _timed(func, *args, **kwargs):
+    start = time.time()
+    ret = func(*args, **kwargs)
+    return ret, time.time() - start
+
+
+def _result(records, seconds):
+    return {'records': records,
+            'seconds': round(seconds, 6),
+            'per_second': round(records / seconds, 1) if seconds else None}
+
+
+_STAGES = {
+    'zone':   (transform.zones,   models.Zone,   'eid'),
+    'city':   (transform.cities,  models.City,   'eid'),
+    'street': (transform.streets, models.Street, 'eid'),
+    'office': (transform.offices, models.Office, 'eid')}
+
+
+def run(sizes=None, seed=0, batch_size=500):
+    """Run all benchmarks and return the results as a JSON-friendly
+    dict.  Rows are written to the default database, so run this
+    against a throwaway one (see the `benchmark` management command).
+
+    """
+    raw = generate(sizes, seed)
+    results = collections.OrderedDict()
+    resolver = inserter.RelationResolver()
+    cities = []
+
+    for name, data in raw.items():
+        ftransform, model, unique = _STAGES[name]
+        n = len(data)
+
+        data, t = _timed(ftransform, data)
+        results['transform.{}'.format(name)] = _result(n, t)
+        if name == 'city':
+            cities = copy.deepcopy(data)
+
+        data, t = _timed(lambda: [resolver.resolve(e) for e in data])
+        results['resolve.{}'.format(name)] = _result(n, t)
+
+        _, t = _timed(inserter.bulk_insert, data, model, unique, 0,
+                      batch_size, resolver)
+        results['write.{}'.format(name)] = _result(n, t)
+        resolver.invalidate(name)
+
+    # Loading rows without touching the custom fields
+    _, t = _timed(lambda: [c.name for c in models.City.objects.all()])
+    results['read.city'] = _result(len(cities), t)
+
+    # Custom fields, over every office list and service days of a city
+    office_list = fields.OfficeListField()
+    week_days = fields.WeekDaysField()
+    names = [f.name for f in models.City._meta.fields
+             if isinstance(f, fields.OfficeListField)]
+    lists = [c[k] for c in cities for k in names]
+    days = [c['service_days'] for c in cities]
+
+    prepared, t = _timed(lambda: [office_list.get_prep_value(v)
+                                  for v in lists])
+    results['field.office_list.get_prep_value'] = _result(len(lists), t)
+    _, t = _timed(lambda: [office_list.to_python(v) for v in prepared])
+    results['field.office_list.to_python'] = _result(len(lists), t)
+
+    prepared, t = _timed(lambda: [week_days.get_prep_value(v) for v in days])
+    results['field.week_days.get_prep_value'] = _result(len(days), t)
+    _, t = _timed(lambda: [week_days.to_python(v) for v in prepared])
+    results['field.week_days.to_python'] = _result(len(days), t)
+
+    return collections.OrderedDict([
+        ('python', platform.python_version()),
+        ('django', django.get_version()),
+        ('seed', seed),
+        ('sizes', _sizes(sizes)),
+        ('results', results)])
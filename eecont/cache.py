@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import collections
+import functools
+import threading
+
+
+class LRUCache(object):
+    """A bounded, thread-safe mapping that evicts the least recently
+    used entry once it grows beyond `maxsize`.  The number of hits and
+    misses is counted, so that the cache can be sized appropriately.
+
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self._data), 'maxsize': self.maxsize}
+
+
+_MISSING = object()
+
+
+def memoize(maxsize=1024):
+    """Decorator that caches the results of a function of hashable
+    positional arguments in an `LRUCache`, available as the `cache`
+    attribute of the decorated function.  Exceptions aren't cached.
+
+    """
+    def decorator(func):
+        cache = LRUCache(maxsize)
+
+        @functools.wraps(func)
+        def wrapper(*args):
+            ret = cache.get(args, _MISSING)
+            if ret is _MISSING:
+                ret = func(*args)
+                cache.set(args, ret)
+            return ret
+
+        wrapper.cache = cache
+        return wrapper
+    return decorator
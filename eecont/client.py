@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import contextlib
+import functools
+import threading
+
+from django.conf import settings
+from django.utils.six.moves import queue
+
+import remoteecont
+
+
+class PoolExhausted(Exception):
+    """Raised when no client became available within the pool's
+    timeout."""
+
+
+def factory(service_url, parcel_url, username, password):
+    """Return a callable that creates a new Econt client."""
+    return functools.partial(
+        remoteecont.RemoteEcontXml, service_url, parcel_url, username,
+        password, remoteecont.CurlTransfer)
+
+
+class ClientPool(object):
+    """A thread-safe pool of at most `size` Econt clients.
+
+    Clients are created lazily by `factory` and handed back to the
+    pool after use, so that their transfers (and the connections they
+    keep alive) are reused.  The most recently used client is handed
+    out first.  A client that raised an exception is thrown away.
+
+    `timeout` is the number of seconds to wait for a free client
+    before giving up with `PoolExhausted`; None waits forever.
+
+    """
+
+    def __init__(self, factory, size=4, timeout=None):
+        self.factory = factory
+        self.size = size
+        self.timeout = timeout
+        self.created = 0
+        self.reused = 0
+        self._lock = threading.Lock()
+        self._slots = queue.LifoQueue(size)
+        for _ in range(size):
+            self._slots.put(None)
+
+    @contextlib.contextmanager
+    def client(self):
+        try:
+            econt = self._slots.get(timeout=self.timeout)
+        except queue.Empty:
+            raise PoolExhausted('No Econt client available after {}s'.format(
+                    self.timeout))
+
+        with self._lock:
+            if econt is None:
+                self.created += 1
+            else:
+                self.reused += 1
+
+        ok = False
+        try:
+            if econt is None:
+                econt = self.factory()
+            yield econt
+            ok = True
+        finally:
+            self._slots.put(econt if ok else None)
+
+    def stats(self):
+        return {'size': self.size, 'created': self.created,
+                'reused': self.reused}
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def pool():
+    """Return the process-wide pool, built on first use from
+    `settings.EECONT['login']` and the optional `settings.EECONT['pool']`
+    dict with the `size` and `timeout` keys.
+
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            login = settings.EECONT['login']
+            conf = settings.EECONT.get('pool', {})
+            _pool = ClientPool(
+                factory(login['service_url'], login['parcel_url'],
+                        login['username'], login['password']),
+                size=conf.get('size', 4), timeout=conf.get('timeout'))
+        return _pool
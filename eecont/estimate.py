@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+
+"""Offline delivery cost estimates.
+
+Econt prices depend mostly on the receiver's zone, the weight and the
+cash on delivery amount.  `learn` asks Econt for the price of every
+(zone, weight bucket, COD bracket) combination once and stores it as a
+`Tariff`; `estimate_delivery` then answers in-process.  `reconcile`
+compares a sample of estimates against real quotes and reports the
+drift.
+
+The buckets are configured in `settings.EECONT['estimate']`:
+
+- `weights`: upper bounds of the weight buckets, in kilograms.
+- `cod`: upper bounds of the cash on delivery brackets, in coins.
+- `reload`: seconds after which a process reloads the tariff table.
+
+"""
+
+from __future__ import unicode_literals
+
+import bisect
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.db import transaction
+
+import eecont
+from eecont import cache
+from eecont import models
+from eecont import nomenclature
+
+
+WEIGHTS = [1, 2, 3, 5, 10, 20, 32, 50]
+COD = [0, 5000, 10000, 25000, 50000, 100000]
+
+
+def _conf():
+    return settings.EECONT.get('estimate', {})
+
+
+def _bucket(bounds, value):
+    """Return the smallest bound >= `value` or None if it's too big."""
+    bounds = sorted(bounds)
+    i = bisect.bisect_left(bounds, value)
+    return bounds[i] if i < len(bounds) else None
+
+
+def _weight(shipment):
+    return _bucket(_conf().get('weights', WEIGHTS),
+                   float(shipment.get('weight', 0)))
+
+
+def _cod(services):
+    return _bucket(_conf().get('cod', COD), int(services.get('payment', 0)))
+
+
+# (nomenclature version, post code, city name) -> zone pk
+_zones = cache.LRUCache(4096)
+
+
+def _zone_id(address):
+    """Return the zone of the receiver's city, looked up by post code
+    or, failing that, by name.
+
+    """
+    post_code, name = address.get('post_code'), address.get('city')
+    key = (nomenclature.version(), post_code, name)
+    zone_id = _zones.get(key)
+    if zone_id is None:
+        cities = models.City.objects.all()
+        if post_code:
+            cities = cities.filter(post_code=post_code)
+        elif name:
+            cities = cities.filter(name__iexact=name)
+        else:
+            return None
+        zone_id = cities.values_list('zone_id', flat=True).first()
+        if zone_id is not None:
+            _zones.set(key, zone_id)
+    return zone_id
+
+
+class _Table(object):
+
+    def __init__(self):
+        self.loaded = 0
+        self.data = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if time.time() - self.loaded > _conf().get('reload', 60 * 60):
+                self.data = dict(
+                    ((zone_id, weight, cod), cost)
+                    for zone_id, weight, cod, cost
+                    in models.Tariff.objects.values_list(
+                        'zone_id', 'weight', 'cod', 'cost'))
+                self.loaded = time.time()
+            return self.data.get(key)
+
+    def invalidate(self):
+        with self.lock:
+            self.loaded = 0
+
+
+_table = _Table()
+
+
+def estimate_delivery(address, shipment, services=None):
+    """Estimate the delivery cost without asking Econt.  Take the same
+    arguments and return the same `{'cost', 'date'}` dict as
+    `eecont.delivery_info`.  The defaults from `settings.EECONT` are
+    returned if there's no matching tariff.
+
+    """
+    services = services or {}
+    cost = None
+    key = (_zone_id(address), _weight(shipment), _cod(services))
+    if None not in key:
+        cost = _table.get(key)
+
+    defaults = settings.EECONT['defaults']
+    return {
+        'cost': cost or defaults.get('delivery_cost'),
+        'date': defaults.get('delivery_date'),
+    }
+
+
+def learn(zones=None):
+    """Ask Econt for the cost of every weight bucket and COD bracket in
+    each of `zones` (all zones by default), quoting a shipment to one
+    city of the zone, and store the results as `Tariff`s.  Return the
+    number of stored tariffs.
+
+    """
+    zones = zones or models.Zone.objects.all()
+    weights = _conf().get('weights', WEIGHTS)
+    brackets = _conf().get('cod', COD)
+    count = 0
+    for zone in zones:
+        city = models.City.objects.filter(zone=zone).first()
+        if city is None:
+            continue
+        address = {'city': city.name, 'post_code': city.post_code}
+        for weight in weights:
+            for cod in brackets:
+                cost, _ = eecont._quote(
+                    address, {'weight': '{:g}'.format(weight)},
+                    {'payment': cod})
+                if cost is None:
+                    continue
+                with transaction.atomic():
+                    models.Tariff.objects.filter(
+                        zone=zone, weight=weight, cod=cod).delete()
+                    models.Tariff.objects.create(
+                        zone=zone, weight=weight, cod=cod, cost=cost)
+                count += 1
+    _table.invalidate()
+    return count
+
+
+def reconcile(samples=20, seed=None):
+    """Compare `samples` estimates for random cities, weights and COD
+    amounts against real quotes from Econt.  Return a dict with the
+    number of `samples` compared, and the mean and maximum absolute
+    and relative drift.
+
+    """
+    rnd = random.Random(seed)
+    weights = _conf().get('weights', WEIGHTS)
+    brackets = _conf().get('cod', COD)
+    city_ids = list(models.City.objects.values_list('pk', flat=True))
+    drifts = []
+    for _ in range(min(samples, len(city_ids))):
+        city = models.City.objects.get(pk=rnd.choice(city_ids))
+        address = {'city': city.name, 'post_code': city.post_code}
+        shipment = {'weight': '{:.1f}'.format(
+                rnd.uniform(0.1, max(weights)))}
+        services = {'payment': rnd.randint(0, max(brackets))}
+
+        key = (city.zone_id, _weight(shipment), _cod(services))
+        estimated = _table.get(key)
+        actual, _ = eecont._quote(address, shipment, services)
+        if estimated is not None and actual:
+            drifts.append((abs(estimated - actual),
+                           abs(estimated - actual) / float(actual)))
+
+    if not drifts:
+        return {'samples': 0}
+    return {
+        'samples': len(drifts),
+        'mean_abs': sum(d[0] for d in drifts) / float(len(drifts)),
+        'max_abs': max(d[0] for d in drifts),
+        'mean_rel': sum(d[1] for d in drifts) / len(drifts),
+        'max_rel': max(d[1] for d in drifts),
+    }
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+"""Complete nomenclature dumps for clients that filter on their own.
+
+`build` writes every payload once per `nomenclature.version` as compact
+JSON, next to gzipped (and, if the `brotli` module is installed,
+brotli-compressed) copies, so that `views.dump` only has to stream a
+file.  The layout of `directory` is::
+
+    current -> <version>/
+    <version>/cities.json[.gz|.br]
+    <version>/quarters.json[.gz|.br]
+    <version>/quarters/<city eid>.json[.gz|.br]
+    <version>/streets.json[.gz|.br]
+    <version>/streets/<city eid>.json[.gz|.br]
+
+`current` is swapped atomically, so readers never see a partial dump.
+
+"""
+
+from __future__ import unicode_literals
+
+import gzip
+import itertools
+import json
+import os
+import re
+import shutil
+
+from eecont import models
+from eecont import nomenclature
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+CURRENT = 'current'
+
+# Extension -> Content-Encoding, preferred first
+ENCODINGS = [('.br', 'br'), ('.gz', 'gzip'), ('', 'identity')]
+
+_FIELDS = ['eid', 'name', 'name_en']
+
+# `nomenclature.version` tokens and the leftovers of interrupted builds,
+# anything else in the directory isn't ours
+_VERSION = re.compile(r'^[0-9a-f]{16}(\.tmp)?$')
+
+
+def _write(path, data):
+    """Write `data`, a JSON-able object, to `path` and its compressed
+    siblings.
+
+    """
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+
+    raw = json.dumps(data, ensure_ascii=False,
+                     separators=(',', ':')).encode('utf-8')
+    with open(path, 'wb') as f:
+        f.write(raw)
+    f = gzip.open('{}.gz'.format(path), 'wb', 9)
+    try:
+        f.write(raw)
+    finally:
+        f.close()
+    if brotli is not None:
+        with open('{}.br'.format(path), 'wb') as f:
+            f.write(brotli.compress(raw))
+
+
+def _by_city(directory, name, model, city_eids):
+    """Write the whole `model` as `name` and one dump per city."""
+    rows = model.objects.order_by('city', 'name')\
+                        .values_list('city_id', *_FIELDS).iterator()
+    everything = []
+    empty = set(city_eids)
+    for city_id, group in itertools.groupby(rows, lambda r: r[0]):
+        entries = [dict(zip(_FIELDS, row[1:])) for row in group]
+        _write(os.path.join(directory, name,
+                            '{}.json'.format(city_eids[city_id])),
+               entries)
+        empty.discard(city_id)
+        for entry in entries:
+            entry['city'] = city_eids[city_id]
+        everything.extend(entries)
+    # So that a city without any is told apart from an unknown one
+    for city_id in empty:
+        _write(os.path.join(directory, name,
+                            '{}.json'.format(city_eids[city_id])), [])
+    _write(os.path.join(directory, '{}.json'.format(name)), everything)
+
+
+def build(directory):
+    """Write the dumps of the current nomenclature version to
+    `directory` and make them current.  Return the version.
+
+    """
+    version = nomenclature.version()
+    target = os.path.join(directory, version)
+    tmp = '{}.tmp'.format(target)
+    if os.path.isdir(tmp):
+        shutil.rmtree(tmp)
+
+    cities = list(models.City.objects.order_by('name')
+                  .values('pk', 'post_code', *_FIELDS))
+    city_eids = dict((c.pop('pk'), c['eid']) for c in cities)
+    _write(os.path.join(tmp, 'cities.json'), cities)
+    _by_city(tmp, 'quarters', models.Quarter, city_eids)
+    _by_city(tmp, 'streets', models.Street, city_eids)
+
+    if os.path.isdir(target):
+        shutil.rmtree(target)
+    os.rename(tmp, target)
+
+    link = os.path.join(directory, CURRENT)
+    if os.path.lexists('{}.tmp'.format(link)):
+        os.remove('{}.tmp'.format(link))
+    os.symlink(version, '{}.tmp'.format(link))
+    os.rename('{}.tmp'.format(link), link)
+
+    # Old versions are no longer referenced
+    for name in os.listdir(directory):
+        old = os.path.join(directory, name)
+        if name != version and _VERSION.match(name) \
+           and os.path.isdir(old) and not os.path.islink(old):
+            shutil.rmtree(old)
+    return version
+
+
+def current(directory):
+    """Return the version of the current dumps or None."""
+    link = os.path.join(directory, CURRENT)
+    if not os.path.islink(link):
+        return None
+    return os.readlink(link)
+
+
+def path(directory, name, city=None):
+    """Return the path of the uncompressed dump of `name` (cities,
+    quarters or streets), or of the quarters or streets of the city
+    with Econt id `city`.
+
+    """
+    if city is not None:
+        return os.path.join(directory, CURRENT, name, '{}.json'.format(city))
+    return os.path.join(directory, CURRENT, '{}.json'.format(name))
@@ -10,7 +10,55 @@ from django.db import models
 from django.utils import six
 
 
-class OfficeListField(six.with_metaclass(models.SubfieldBase, models.Field)):
+class _Raw(object):
+    """A value assigned to a `LazyDecoder` field, not decoded yet."""
+
+    def __init__(self, value):
+        self.value = value
+
+
+class LazyDecoder(object):
+    """Descriptor that keeps the value of `field` as it was assigned
+    (e.g. the raw column value loaded from the database) and decodes it
+    with `field.to_python` on first access only.  The decoded value is
+    cached on the instance until the next assignment.
+
+    Either value is kept under the attname in the instance `__dict__`,
+    where `Model.save()` of deferred models looks for loaded fields.
+
+    """
+
+    def __init__(self, field):
+        self.field = field
+
+    def __get__(self, obj, type=None):
+        if obj is None:
+            return self
+        try:
+            value = obj.__dict__[self.field.attname]
+        except KeyError:
+            raise AttributeError(self.field.attname)
+        if isinstance(value, _Raw):
+            value = obj.__dict__[self.field.attname] = \
+                self.field.to_python(value.value)
+        return value
+
+    def __set__(self, obj, value):
+        obj.__dict__[self.field.attname] = _Raw(value)
+
+
+class LazyFieldMixin(object):
+    """Use `LazyDecoder` instead of `SubfieldBase`, so that loading a
+    row doesn't decode columns that are never read.
+
+    """
+
+    def contribute_to_class(self, cls, name):
+        super(LazyFieldMixin, self).contribute_to_class(cls, name)
+        setattr(cls, self.name, LazyDecoder(self))
+
+
+class OfficeListField(LazyFieldMixin, models.Field):
 
     description = 'Hold a list of Econt office codes'
 
@@ -46,7 +94,7 @@ class OfficeListField(six.with_metaclass(models.SubfieldBase, models.Field)):
             raise exceptions.ValidationError(msg)
 
 # TODO: widget?
-class WeekDaysField(six.with_metaclass(models.SubfieldBase, models.Field)):
+class WeekDaysField(LazyFieldMixin, models.Field):
 
     description = 'Field that holds a boolean value for each day of the week'
 
@@ -3,16 +3,24 @@
 
 from __future__ import unicode_literals
 
+from multiprocessing.pool import ThreadPool
 import collections
+import itertools
 import sys
 
 from django.core import exceptions
+from django.db import transaction
 from django.utils import six
 from django.utils.six import print_
 
+from eecont import autocomplete
+from eecont import client
+from eecont import export
+from eecont import fields
 from eecont import models
+from eecont import nomenclature
+from eecont import snapshot
 from eecont import transform
-import remoteecont
 
 
 ###############
@@ -40,6 +48,16 @@ def _log_update(obj, verbosity=1, priority=2):
 # Insert helpers #
 ##################
 
+# TODO: repetition, see `orders` in fetch_and_insert
+_MODEL2UNIQUE = {
+    'zone':    {'model': models.Zone,    'unique': 'eid'},
+    'country': {'model': models.Country, 'unique': 'name'},
+    'city':    {'model': models.City,    'unique': 'eid'},
+    'quarter': {'model': models.Quarter, 'unique': 'eid'},
+    'street':  {'model': models.Street,  'unique': 'eid'},
+    'office':  {'model': models.Office,  'unique': 'eid'}}
+
+
 def _get_obj(model, unique_key, unique_val):
     lookup = {unique_key: unique_val}
     try:
@@ -50,30 +68,163 @@ def _get_obj(model, unique_key, unique_val):
 
 
 def populate_relations(data):
-    # TODO: repetition, see `orders` in fetch_and_insert
-    model2unique = {
-        'zone':    {'model': models.Zone,    'unique': 'eid'},
-        'country': {'model': models.Country, 'unique': 'name'},
-        'city':    {'model': models.City,    'unique': 'eid'},
-        'quarter': {'model': models.Quarter, 'unique': 'eid'},
-        'street':  {'model': models.Street,  'unique': 'eid'},
-        'office':  {'model': models.Office,  'unique': 'eid'}}
-
-    for name, v in six.iteritems(model2unique):
+    for name, v in six.iteritems(_MODEL2UNIQUE):
         if name in data:
             data[name] = _get_obj(v['model'], v['unique'], data[name])
     return data
 
 
+class RelationResolver(object):
+    """Resolve related objects by their unique key without a query per
+    row.  The `unique -> pk` map of each related model is loaded once,
+    on first use, and the primary key is assigned directly to the
+    `<name>_id` attribute.  Unresolvable keys are collected and
+    reported at once by `report()`.
+
+    """
+
+    def __init__(self):
+        self._maps = {}
+        self.missing = collections.defaultdict(set)
+
+    def _map(self, name):
+        if name not in self._maps:
+            v = _MODEL2UNIQUE[name]
+            self._maps[name] = dict(
+                v['model'].objects.values_list(v['unique'], 'pk'))
+        return self._maps[name]
+
+    def invalidate(self, name):
+        """Forget the cached map of `name`, e.g. after its model has
+        been (re)inserted."""
+        self._maps.pop(name, None)
+
+    def resolve(self, data):
+        """Replace every relation in `data` with its `<name>_id`.  Raise
+        `ObjectDoesNotExist` if any of them can't be found.
+
+        """
+        ok = True
+        for name in [k for k in _MODEL2UNIQUE if k in data]:
+            value = data.pop(name)
+            pk = self._map(name).get(value)
+            if pk is None:
+                self.missing[name].add(value)
+                ok = False
+            data['{}_id'.format(name)] = pk
+        if not ok:
+            raise exceptions.ObjectDoesNotExist()
+        return data
+
+    def report(self, verbosity=1):
+        """Log a summary of the missing related objects and reset it."""
+        for name, values in sorted(six.iteritems(self.missing)):
+            _log_general('\tMissing {} {}: {}'.format(
+                    len(values), name,
+                    ', '.join(sorted(six.text_type(v) for v in values))),
+                         verbosity)
+        self.missing.clear()
+
+
+def get_watermark(name):
+    try:
+        return models.SyncState.objects.get(name=name).watermark
+    except models.SyncState.DoesNotExist:
+        return None
+
+
+def set_watermark(name, value):
+    state, _ = models.SyncState.objects.get_or_create(name=name)
+    state.watermark = value
+    state.save(update_fields=['watermark'])
+
+
+def filter_changed(data, model, unique_field, watermark=None):
+    """Drop the entries of `data` that are already stored and whose
+    `updated_time` hasn't advanced past either `watermark` or the
+    stored row's own `updated_time`.  New entries are always kept.
+
+    Only the rows referenced by `data` are queried, so keep it short
+    (e.g. `batch_size` entries).  Return a `(changed, skipped)` tuple.
+
+    """
+    lookup = {'{}__in'.format(unique_field): [e[unique_field] for e in data]}
+    stored = dict(model.objects.filter(**lookup)
+                  .values_list(unique_field, 'updated_time'))
+    changed, skipped = [], 0
+    for entry in data:
+        key = entry[unique_field]
+        if key in stored:
+            t = entry['updated_time']
+            if (watermark is not None and t <= watermark) or t <= stored[key]:
+                skipped += 1
+                continue
+        changed.append(entry)
+    return changed, skipped
+
+
+def _chunks(iterable, size):
+    it = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _summary():
+    return collections.Counter(inserted=0, updated=0, unchanged=0, deleted=0)
+
+
+def _changed(summary):
+    return bool(summary['inserted'] or summary['updated'] or
+                summary['deleted'])
+
+
+def diff(obj, data):
+    """Return a list of the fields in `data` whose values differ from
+    the ones stored in `obj`.  Values are compared in their prepared
+    (database) form, so e.g. `[1000, 1001]` and a freshly loaded
+    `OfficeListField` compare equal.
+
+    Relations may be given either as model instances (`zone`) or as
+    primary keys (`zone_id`).
+
+    """
+    fields = {}
+    for f in obj._meta.fields:
+        fields[f.name] = fields[f.attname] = f
+
+    changed = []
+    for k, v in six.iteritems(data):
+        field = fields[k]
+        if field.rel:
+            old = getattr(obj, field.attname)
+            new = getattr(v, 'pk', v)
+        else:
+            old = field.get_prep_value(getattr(obj, k))
+            new = field.get_prep_value(v)
+        if old != new:
+            changed.append(k)
+    return changed
+
+
 #############
 # Inserters #
 #############
 
-def insert(data, model, unique_field, verbosity=1):
+def insert(data, model, unique_field, verbosity=1, resolver=None):
+    """Insert or update a single entry and return `'inserted'`,
+    `'updated'` or `'unchanged'`.
+
+    """
     if isinstance(model, six.text_type):
         model = getattr(models, model)
 
-    data = populate_relations(data)
+    if resolver is None:
+        data = populate_relations(data)
+    else:
+        data = resolver.resolve(data)
     args = {unique_field: data.pop(unique_field),
             'defaults': data}
 
@@ -81,60 +232,343 @@ def insert(data, model, unique_field, verbosity=1):
 
     if created:
         _log_insert(obj, verbosity)
-    else:
-        for k, v in six.iteritems(data):
-            setattr(obj, k, v)
-        obj.save()
+        return 'inserted'
+
+    changed = diff(obj, data)
+    if not changed:
+        return 'unchanged'
+
+    for k in changed:
+        setattr(obj, k, data[k])
+    obj.save(update_fields=changed)
+    _log_update(obj, verbosity)
+    return 'updated'
+
+
+def insert_many(data, model, unique_field, verbosity=1, resolver=None,
+                changed=None):
+    """Insert or update every entry in `data` one by one.  This is the
+    slow path: each entry costs a `get_or_create` and possibly a
+    `save()`.
+
+    Return a summary `Counter` just like `bulk_insert`.
+
+    """
+    summary = _summary()
+    for entry in data:
+        key = entry[unique_field]
+        try:
+            result = insert(entry, model, unique_field, verbosity, resolver)
+            summary[result] += 1
+            if changed is not None and result != 'unchanged':
+                changed.add(key)
+        except exceptions.ObjectDoesNotExist as e:
+            if resolver is None:
+                _log_general('\tError while inserting an {}: {}'.format(
+                        model.__name__, e), verbosity)
+    return summary
+
+
+def bulk_insert(data, model, unique_field, verbosity=1, batch_size=500,
+                resolver=None, changed=None):
+    """Insert or update all entries in `data` with as few queries as
+    possible.  `data` is consumed in chunks of `batch_size` entries:
+    the stored rows of each chunk are loaded with a single query, new
+    entries are written with `bulk_create` and only the changed
+    columns of the existing ones are updated.  Everything happens
+    inside a single transaction.
+
+    Return a `Counter` with the number of inserted, updated and
+    unchanged entries.  If `changed` is a set, the unique keys of the
+    inserted and updated entries are added to it.
+
+    """
+    if isinstance(model, six.text_type):
+        model = getattr(models, model)
+
+    if resolver is None:
+        resolver = RelationResolver()
+
+    summary = _summary()
+    with transaction.atomic():
+        for chunk in _chunks(data, batch_size):
+            summary.update(_bulk_insert_chunk(chunk, model, unique_field,
+                                              verbosity, resolver, changed))
+    return summary
+
+
+def _bulk_insert_chunk(data, model, unique_field, verbosity, resolver,
+                       changed=None):
+    lookup = {'{}__in'.format(unique_field): [e[unique_field] for e in data]}
+    existing = dict((getattr(o, unique_field), o)
+                    for o in model.objects.filter(**lookup))
+    to_create = collections.OrderedDict()
+    to_update = []
+    summary = _summary()
+
+    for entry in data:
+        try:
+            entry = resolver.resolve(entry)
+        except exceptions.ObjectDoesNotExist:
+            continue
+
+        key = entry[unique_field]
+        if key in existing:
+            obj = existing[key]
+            columns = diff(obj, entry)
+            if columns:
+                for k in columns:
+                    setattr(obj, k, entry[k])
+                to_update.append((obj, columns))
+            else:
+                summary['unchanged'] += 1
+        else:
+            # Later duplicates override earlier ones, just like the
+            # per-row path would do
+            to_create[key] = model(**entry)
+
+    to_create = list(six.itervalues(to_create))
+    model.objects.bulk_create(to_create)
+    for obj in to_create:
+        _log_insert(obj, verbosity)
+
+    for obj, columns in to_update:
+        obj.save(update_fields=columns)
         _log_update(obj, verbosity)
 
+    if changed is not None:
+        changed.update(getattr(o, unique_field) for o in to_create)
+        changed.update(getattr(o, unique_field) for o, _ in to_update)
+
+    summary['inserted'] = len(to_create)
+    summary['updated'] = len(to_update)
+    return summary
+
+
+def prune(model, unique_field, keys, batch_size=500):
+    """Delete the rows of `model` whose unique field is not in `keys`
+    and return their number.
+
+    """
+    stale = [pk for pk, key in model.objects.values_list('pk', unique_field)
+             if key not in keys]
+    with transaction.atomic():
+        for chunk in _chunks(stale, batch_size):
+            model.objects.filter(pk__in=chunk).delete()
+    return len(stale)
+
+
+def link_services(batch_size=500, eids=None):
+    """Rebuild `models.ServiceLink` from the office lists of the cities
+    with Econt ids `eids`, or of all cities if not given.  Return the
+    number of links written.
+
+    """
+    names = [f.name for f in models.City._meta.fields
+             if isinstance(f, fields.OfficeListField)]
+    field = models.City._meta.get_field(names[0])
+
+    def links(cities):
+        for row in cities.values_list('pk', *names).iterator():
+            for name, codes in zip(names, row[1:]):
+                shipment, direction, kind = name.split('_')
+                for code in field.to_python(codes):
+                    yield models.ServiceLink(
+                        city_id=row[0], office_code=code, shipment=shipment,
+                        direction=direction, kind=kind)
+
+    def rebuild(cities):
+        count = 0
+        models.ServiceLink.objects.filter(city__in=cities).delete()
+        for chunk in _chunks(links(cities), batch_size):
+            models.ServiceLink.objects.bulk_create(chunk)
+            count += len(chunk)
+        return count
+
+    with transaction.atomic():
+        if eids is None:
+            models.ServiceLink.objects.all().delete()
+            return rebuild(models.City.objects.all())
+        # Keep the IN clauses short
+        return sum(rebuild(models.City.objects.filter(eid__in=chunk))
+                   for chunk in _chunks(eids, batch_size))
+
+
+def store(name, data, model, unique_field, resolver=None, changed=None,
+          **kwargs):
+    """Write the transformed `data` of the nomenclature `name` (zone,
+    city, ...) to `model` and return a summary `Counter`.  `data` may
+    be any iterable; it's consumed in chunks of `batch_size` entries
+    inside a single transaction.  If `changed` is a set, the unique
+    keys of the inserted and updated entries are added to it.
+
+    Keyword arguments are the same as the ones of `fetch_and_insert`:
+    `verbosity`, `bulk`, `batch_size`, `incremental` and `prune`.
+
+    """
+    verbosity   = kwargs.get('verbosity', 1)
+    bulk        = kwargs.get('bulk', True)
+    batch_size  = kwargs.get('batch_size') or 500
+    incremental = kwargs.get('incremental', False)
+    delete      = kwargs.get('prune', False)
+
+    if resolver is None:
+        resolver = RelationResolver()
+
+    # Countries have no `updated_time`, hence no watermark either
+    timed = incremental and \
+        'updated_time' in model._meta.get_all_field_names()
+    since = get_watermark(name) if timed else None
+    watermark = None
+    keys = set()
+    summary = _summary()
+
+    _log_general('\tInserting {} data'.format(name.capitalize()), verbosity)
+    with transaction.atomic():
+        for chunk in _chunks(data, batch_size):
+            keys.update(e[unique_field] for e in chunk)
+
+            if timed:
+                latest = max(e['updated_time'] for e in chunk)
+                watermark = max(watermark or latest, latest)
+                chunk, skipped = filter_changed(
+                    chunk, model, unique_field, since)
+                summary['unchanged'] += skipped
+
+            if bulk:
+                summary.update(bulk_insert(chunk, model, unique_field,
+                                           verbosity, batch_size, resolver,
+                                           changed))
+            else:
+                summary.update(insert_many(chunk, model, unique_field,
+                                           verbosity, resolver, changed))
+
+        if delete:
+            summary['deleted'] = prune(model, unique_field, keys, batch_size)
+
+        if watermark is not None:
+            set_watermark(name, watermark)
+
+    _log_general('\tInserted: {inserted}, updated: {updated}, '
+                 'unchanged: {unchanged}, deleted: {deleted}'.format(
+            **summary), verbosity)
+    resolver.report(verbosity)
+    resolver.invalidate(name)
+    return summary
+
 
 def fetch_and_insert(**kwargs):
     which       = kwargs['which'] # which models to fetch & insert
-    parcel_url  = kwargs['parcel_url']
-    service_url = kwargs['service_url']
-    username    = kwargs['username']
-    password    = kwargs['password']
+    parcel_url  = kwargs.get('parcel_url')
+    service_url = kwargs.get('service_url')
+    username    = kwargs.get('username')
+    password    = kwargs.get('password')
     verbosity   = kwargs['verbosity']
+    jobs        = kwargs.get('jobs') or 1
+    stream      = kwargs.get('stream', False)
 
-    econt = remoteecont.RemoteEcontXml(
-        service_url, parcel_url, username, password, remoteecont.CurlTransfer)
+    # Store the raw responses in `snapshot_dir` or, if `from_snapshot`
+    # is set, replay them from there instead of hitting the network.
+    # `from_snapshot` is either a date (YYYY-MM-DD) or 'latest'.
+    snapshot_dir  = kwargs.get('snapshot_dir')
+    from_snapshot = kwargs.get('from_snapshot')
+    if from_snapshot and not snapshot_dir:
+        raise ValueError('Replaying requires a snapshot directory')
+    snapshot_date = from_snapshot
+
+    # Build the dumps served by `views.dump` here, see `eecont.export`
+    export_dir = kwargs.get('export_dir')
+
+    # One client per download thread at most
+    clients = client.ClientPool(
+        client.factory(service_url, parcel_url, username, password), jobs)
 
     order = collections.OrderedDict(
-        [('zone', {'model': models.Zone, 'fget': econt.cities_zones,
+        [('zone', {'model': models.Zone, 'fget': 'cities_zones',
                    'ftransform': transform.zones, 'unique': 'eid'}),
 
-         ('country', {'model': models.Country, 'fget': econt.countries,
+         ('country', {'model': models.Country, 'fget': 'countries',
                       'ftransform': transform.countries, 'unique': 'name'}),
 
-         ('city', {'model': models.City, 'fget': econt.cities,
+         ('city', {'model': models.City, 'fget': 'cities',
                    'ftransform': transform.cities, 'unique': 'eid'}),
 
-         ('quarter', {'model': models.Quarter, 'fget': econt.cities_quarters,
+         ('quarter', {'model': models.Quarter, 'fget': 'cities_quarters',
                       'ftransform': transform.quarters, 'unique': 'eid'}),
 
-         ('street', {'model': models.Street, 'fget': econt.cities_streets,
+         ('street', {'model': models.Street, 'fget': 'cities_streets',
                      'ftransform': transform.streets, 'unique': 'eid'}),
 
-         ('office', {'model': models.Office, 'fget': econt.offices,
+         ('office', {'model': models.Office, 'fget': 'offices',
                      'ftransform': transform.offices, 'unique': 'eid'})])
 
     which = which or order.keys()
-    f = lambda t: t[0] in which
-
-    for m, v in filter(f, six.iteritems(order)):
-        _log_general('Now processing: {}'.format(m), verbosity)
-
-        data = v['fget']()
-        _log_general('\tFetched: {} entries'.format(len(data)), verbosity)
-
+    selected = [t for t in six.iteritems(order) if t[0] in which]
+    if from_snapshot == 'latest':
+        # The same day for every nomenclature
+        snapshot_date = snapshot.latest(snapshot_dir,
+                                        [m for m, _ in selected])
+    resolver = RelationResolver()
+    summaries = collections.OrderedDict()
+    # Econt ids of the inserted and updated cities
+    cities = set()
+
+    # Downloading and transforming don't depend on each other, so they
+    # may run concurrently.  Inserting on the other hand must follow
+    # `order` because of the relations.
+    def fetch_and_transform(item):
+        m, v = item
+        if from_snapshot:
+            data = snapshot.load(snapshot_dir, m, snapshot_date)
+        else:
+            with clients.client() as econt:
+                data = getattr(econt, v['fget'])()
+            if snapshot_dir:
+                snapshot.save(snapshot_dir, m, data)
+        _log_general('\tFetched {}: {} entries'.format(m, len(data)),
+                     verbosity)
+        if stream:
+            # Transform lazily, one record at a time, while inserting
+            return m, v, transform.iterate(v['ftransform'], data)
         data = v['ftransform'](data)
         _log_general('\t{} data successfully transformed'.format(
                 m.capitalize()), verbosity)
+        return m, v, data
 
-        _log_general('\tInserting {} data'.format(m.capitalize()))
-        for entry in data:
-            try:
-                insert(entry, v['model'], v['unique'], verbosity=verbosity)
-            except exceptions.ObjectDoesNotExist as e:
-                _log_general('\tError while inserting an {}: {}'.format(m, e),
-                             verbosity)
+    pool = None
+    if jobs > 1:
+        pool = ThreadPool(jobs)
+        results = pool.imap(fetch_and_transform, selected)
+    else:
+        results = six.moves.map(fetch_and_transform, selected)
+
+    try:
+        for m, v, data in results:
+            _log_general('Now processing: {}'.format(m), verbosity)
+            summaries[m] = store(m, data, v['model'], v['unique'],
+                                 resolver, cities if m == 'city' else None,
+                                 **kwargs)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    if 'city' in summaries:
+        # Only the links of the inserted and updated cities are stale,
+        # those of the deleted ones went away with them
+        eids = cities
+        if not models.ServiceLink.objects.exists():
+            eids = None
+        if eids is None or eids:
+            count = link_services(kwargs.get('batch_size') or 500, eids)
+            _log_general('Linked {} city offices'.format(count), verbosity)
+
+    changed = any(_changed(s) for s in summaries.values())
+    if changed:
+        nomenclature.bump()
+    autocomplete.invalidate()
+    if export_dir and (changed or export.current(export_dir) is None):
+        version = export.build(export_dir)
+        _log_general('Exported version {} to {}'.format(version, export_dir),
+                     verbosity)
+    return summaries
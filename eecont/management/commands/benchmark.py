@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+
+from optparse import make_option
+import json
+
+from django.core.management import base
+from django.db import connection
+
+from eecont import benchmark
+
+
+class Command(base.BaseCommand):
+
+    help = '''Time the transform, relation resolution, database write \
+and field conversion stages against synthetic nomenclatures.  A fresh \
+test database is created for the run, so nothing real is touched.'''
+
+    option_list = base.BaseCommand.option_list + (
+        make_option('--cities', type='int',
+                    default=benchmark.SIZES['city']),
+        make_option('--streets', type='int',
+                    default=benchmark.SIZES['street']),
+        make_option('--offices', type='int',
+                    default=benchmark.SIZES['office']),
+        make_option('--seed', type='int', default=0),
+        make_option('--batch-size', type='int', dest='batch_size',
+                    default=500),
+        make_option('--output', help='Write the JSON results to this file'),
+    )
+
+    def handle(self, *args, **kwargs):
+        sizes = {'city': kwargs['cities'],
+                 'street': kwargs['streets'],
+                 'office': kwargs['offices']}
+
+        old_name = connection.creation.create_test_db(verbosity=0)
+        try:
+            results = benchmark.run(sizes, kwargs['seed'],
+                                    kwargs['batch_size'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        content = json.dumps(results, indent=2)
+        if kwargs['output']:
+            with open(kwargs['output'], 'w') as f:
+                f.write(content)
+        else:
+            self.stdout.write(content)
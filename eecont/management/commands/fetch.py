@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 
+from optparse import make_option
+
 from django.conf import settings
 from django.core.management import base
 from django.utils import six
@@ -13,15 +15,52 @@ class Command(base.BaseCommand):
     args = 'hehe'
     help = '''Fetch and store in the database all the information \
 needed to make delivery requests with the eEcont API.'''
+
+    option_list = base.BaseCommand.option_list + (
+        make_option('--per-row', action='store_false', dest='bulk',
+                    default=True,
+                    help='Insert entries one by one instead of in bulk'),
+        make_option('--batch-size', type='int', dest='batch_size',
+                    default=500,
+                    help='Number of rows per bulk insert statement'),
+        make_option('--incremental', action='store_true', default=False,
+                    help='Only write entries updated since the last sync'),
+        make_option('--prune', action='store_true', default=False,
+                    help='Delete stored entries missing from the response'),
+        make_option('--jobs', type='int', default=1,
+                    help='Number of nomenclatures to download concurrently'),
+        make_option('--stream', action='store_true', default=False,
+                    help='Transform and insert entries lazily, in chunks'),
+        make_option('--snapshot-dir', dest='snapshot_dir',
+                    help='Store the raw responses in this directory '
+                    '(defaults to EECONT["snapshot_dir"])'),
+        make_option('--from-snapshot', dest='from_snapshot', metavar='DATE',
+                    help='Replay the snapshot from DATE (YYYY-MM-DD or '
+                    '"latest") instead of fetching from Econt'),
+        make_option('--export-dir', dest='export_dir',
+                    help='Build the complete nomenclature dumps in this '
+                    'directory (defaults to EECONT["export_dir"])'),
+    )
     
     def handle(self, *args, **kwargs):
-        conf = settings.EECONT['login']
+        conf = settings.EECONT.get('login', {})
 
         which = map(lambda s: six.text_type(s), args)
         which = map(six.text_type.lower, which)
 
         a = {'verbosity': int(kwargs['verbosity']),
-             'which': which}
+             'which': which,
+             'bulk': kwargs['bulk'],
+             'batch_size': kwargs['batch_size'],
+             'incremental': kwargs['incremental'],
+             'prune': kwargs['prune'],
+             'jobs': kwargs['jobs'],
+             'stream': kwargs['stream'],
+             'snapshot_dir': (kwargs['snapshot_dir'] or
+                              settings.EECONT.get('snapshot_dir')),
+             'from_snapshot': kwargs['from_snapshot'],
+             'export_dir': (kwargs['export_dir'] or
+                            settings.EECONT.get('export_dir'))}
         a.update(conf)
 
         inserter.fetch_and_insert(**a)
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+
+from optparse import make_option
+
+from django.core.management import base
+
+from eecont import estimate
+
+
+class Command(base.BaseCommand):
+
+    help = '''Learn the delivery tariffs used by eecont.estimate from \
+Econt and/or report how far the estimates drift from real quotes.'''
+
+    option_list = base.BaseCommand.option_list + (
+        make_option('--learn', action='store_true', default=False,
+                    help='Fetch and store the tariff table'),
+        make_option('--reconcile', type='int', default=0, metavar='N',
+                    help='Compare N random estimates to real quotes'),
+    )
+
+    def handle(self, *args, **kwargs):
+        if kwargs['learn']:
+            count = estimate.learn()
+            self.stdout.write('Stored {} tariffs'.format(count))
+
+        if kwargs['reconcile']:
+            drift = estimate.reconcile(kwargs['reconcile'])
+            for k in sorted(drift):
+                self.stdout.write('{}: {}'.format(k, drift[k]))
@@ -59,9 +59,9 @@ class City(models.Model):
 
     # office = None # TODO
     zone = models.ForeignKey(Zone)
-    name = models.CharField(max_length=100)
+    name = models.CharField(max_length=100, db_index=True)
     name_en = models.CharField(max_length=100)
-    post_code = models.PositiveIntegerField()
+    post_code = models.PositiveIntegerField(db_index=True)
     # region = models.ForeignKey(Region) # TODO
     service_days = fields.WeekDaysField()
     is_village = models.BooleanField() # this corresponds to <type>
@@ -94,6 +94,17 @@ class City(models.Model):
     def __str__(self):
         return 'City: {}'.format(self.name)
 
+    def service_offices(self, shipment=None, direction=None, kind=None):
+        """Return the offices listed for this city, see `ServiceLink`.
+        For example, `city.service_offices('cs', 'to', 'door')` are the
+        offices in `cs_to_door`.
+
+        """
+        links = ServiceLink.filter(self.service_links.all(), shipment,
+                                   direction, kind)
+        return Office.objects.filter(
+            office_code__in=links.values('office_code'))
+
     def __getattr__(self, name):
         """
         Provide an easy way to access service days.  Like this:
@@ -123,6 +134,10 @@ class Quarter(models.Model):
     city = models.ForeignKey(City)
     updated_time = models.DateTimeField()
 
+    class Meta:
+        # Autocomplete within a city, see `eecont.autocomplete`
+        index_together = [['city', 'name']]
+
     def __str__(self):
         return self.name
 
@@ -138,6 +153,10 @@ class Street(models.Model):
     city = models.ForeignKey(City)
     updated_time = models.DateTimeField()
 
+    class Meta:
+        # Autocomplete within a city, see `eecont.autocomplete`
+        index_together = [['city', 'name']]
+
     def __str__(self):
         return self.name
 
@@ -201,3 +220,82 @@ class Office(models.Model):
 
     def __str__(self):
         return self.name
+
+    def served_cities(self, shipment=None, direction=None, kind=None):
+        """Return the cities that list this office, see `ServiceLink`."""
+        links = ServiceLink.filter(
+            ServiceLink.objects.filter(office_code=self.office_code),
+            shipment, direction, kind)
+        return City.objects.filter(pk__in=links.values('city'))
+
+
+@python_2_unicode_compatible
+class ServiceLink(models.Model):
+    """An office code from one of the `City` office lists, so that they
+    can be queried both ways.  Rebuilt from the cities by
+    `inserter.link_services`.
+
+    """
+
+    SHIPMENTS = (('ces', 'cargo express shipments'),
+                 ('cps', 'cargo palet shipments'),
+                 ('cs', 'courier shipments'),
+                 ('ps', 'post shipments'))
+    DIRECTIONS = (('from', 'from'), ('to', 'to'))
+    KINDS = (('door', 'door'), ('office', 'office'))
+
+    city = models.ForeignKey(City, related_name='service_links')
+    office_code = models.PositiveIntegerField()
+    shipment = models.CharField(max_length=3, choices=SHIPMENTS)
+    direction = models.CharField(max_length=4, choices=DIRECTIONS)
+    kind = models.CharField(max_length=6, choices=KINDS)
+
+    class Meta:
+        index_together = [['office_code', 'shipment', 'direction', 'kind'],
+                          ['city', 'shipment', 'direction', 'kind']]
+
+    def __str__(self):
+        return 'ServiceLink: {} {}_{}_{} {}'.format(
+            self.city_id, self.shipment, self.direction, self.kind,
+            self.office_code)
+
+    @staticmethod
+    def filter(qs, shipment=None, direction=None, kind=None):
+        lookup = dict((k, v) for k, v in (('shipment', shipment),
+                                          ('direction', direction),
+                                          ('kind', kind)) if v)
+        return qs.filter(**lookup)
+
+
+@python_2_unicode_compatible
+class SyncState(models.Model):
+    """Bookkeeping for `inserter.fetch_and_insert`, one row per
+    nomenclature (zone, city, street, ...).
+
+    """
+
+    name = models.CharField(max_length=20, unique=True)
+
+    # The highest `updated_time` seen during the last successful sync
+    watermark = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return 'SyncState: {}'.format(self.name)
+
+
+@python_2_unicode_compatible
+class Tariff(models.Model):
+    """A delivery cost learnt from Econt, see `eecont.estimate`."""
+
+    zone = models.ForeignKey(Zone)
+    weight = models.FloatField()              # upper bound of the bucket, kg
+    cod = models.PositiveIntegerField()       # upper bound of the bracket, coins
+    cost = models.PositiveIntegerField()      # coins
+    updated_time = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('zone', 'weight', 'cod')
+
+    def __str__(self):
+        return 'Tariff: {} / {}kg / {}'.format(self.zone_id, self.weight,
+                                               self.cod)
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+"""Version token of the synced nomenclatures.
+
+The City, Quarter and Street tables only change when
+`inserter.fetch_and_insert` runs, which calls `bump` once its changes
+are committed.  Anything derived from the tables (HTTP responses,
+in-memory indexes) can be cached for as long as `version` doesn't
+change.
+
+"""
+
+from __future__ import unicode_literals
+
+import hashlib
+import threading
+import time
+
+from django.conf import settings
+from django.db.models import Max
+from django.utils import six
+from django.utils import timezone
+
+from eecont import models
+
+
+# The SyncState row that keeps the time of the last change
+NAME = 'nomenclature'
+
+_cached = {'version': None, 'loaded': 0}
+_lock = threading.Lock()
+
+
+def _ttl():
+    """Seconds a process trusts its copy of the version."""
+    return settings.EECONT.get('http_cache', {}).get('version_ttl', 60)
+
+
+def _load():
+    stamp = models.SyncState.objects.filter(name=NAME)\
+                                    .values_list('watermark', flat=True)\
+                                    .first()
+    if stamp is None:
+        # Never bumped, derive it from the data itself
+        stamps = [model.objects.aggregate(m=Max('updated_time'))['m']
+                  for model in (models.City, models.Quarter, models.Street)]
+        stamps = [s for s in stamps if s is not None]
+        stamp = max(stamps) if stamps else None
+    return hashlib.md5(six.text_type(stamp).encode('utf-8')).hexdigest()[:16]
+
+
+def version():
+    """Return the current version token, a short hex string."""
+    with _lock:
+        if (_cached['version'] is None or
+                time.time() - _cached['loaded'] > _ttl()):
+            _cached['version'] = _load()
+            _cached['loaded'] = time.time()
+        return _cached['version']
+
+
+def bump():
+    """Start a new version.  Call it after committing changes to the
+    nomenclatures.
+
+    """
+    state, _ = models.SyncState.objects.get_or_create(name=NAME)
+    state.watermark = timezone.now()
+    state.save(update_fields=['watermark'])
+    with _lock:
+        _cached['version'] = None
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+"""On-disk snapshots of the raw nomenclature responses.
+
+Snapshots are stored as gzipped JSON under `<directory>/<date>/<name>.json.gz`
+where `date` is in ISO format (YYYY-MM-DD) and `name` is the nomenclature
+(zone, country, city, ...).
+
+"""
+
+from __future__ import unicode_literals
+
+import datetime
+import errno
+import gzip
+import json
+import os
+import re
+
+
+DATE_RE = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+
+
+def _path(directory, name, date):
+    return os.path.join(directory, date, '{}.json.gz'.format(name))
+
+
+def dates(directory):
+    """Return the dates of all snapshots in `directory`, oldest first."""
+    if not os.path.isdir(directory):
+        return []
+    return sorted(d for d in os.listdir(directory) if DATE_RE.match(d))
+
+
+def save(directory, name, data, date=None):
+    """Store `data` as the snapshot of `name` for `date` (today by
+    default) and return the path of the file.
+
+    """
+    date = date or datetime.date.today().isoformat()
+    path = _path(directory, name, date)
+    try:
+        os.makedirs(os.path.dirname(path))
+    except OSError as e:
+        # Another download thread may have just created it
+        if e.errno != errno.EEXIST:
+            raise
+
+    # Write to a temporary file first, so that a failed sync never
+    # leaves a truncated snapshot behind
+    tmp = '{}.tmp'.format(path)
+    f = gzip.open(tmp, 'wb')
+    try:
+        f.write(json.dumps(data, separators=(',', ':')).encode('ascii'))
+    finally:
+        f.close()
+    os.rename(tmp, path)
+    return path
+
+
+def latest(directory, names):
+    """Return the latest date that has a snapshot of every one of
+    `names`, so that a replay never mixes data from different days.
+    Raise `IOError` if there's no such date.
+
+    """
+    for date in reversed(dates(directory)):
+        if all(os.path.exists(_path(directory, n, date)) for n in names):
+            return date
+    raise IOError('No snapshot of {} in {}'.format(', '.join(names),
+                                                   directory))
+
+
+def load(directory, name, date=None):
+    """Return the snapshot of `name` for `date`.  If `date` is None, the
+    latest snapshot that contains `name` is used.  Raise `IOError` if
+    there's no such snapshot.
+
+    """
+    if date is None:
+        date = latest(directory, [name])
+
+    f = gzip.open(_path(directory, name, date), 'rb')
+    try:
+        return json.loads(f.read().decode('ascii'))
+    finally:
+        f.close()
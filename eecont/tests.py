@@ -4,19 +4,48 @@
 
 from __future__ import unicode_literals
 
+from multiprocessing.pool import ThreadPool
+
 import copy
 import datetime
-
+import gzip
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from django.core import exceptions
+from django.core.cache import get_cache
+from django.core.management.color import no_style
+from django import http
+from django.db import connection
 from django.test import TestCase
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
 from django.conf import settings
 from django.utils import six
 from django.utils import timezone
+from django.utils.unittest import skipUnless
 
 import pytz
 
+import eecont
+from eecont import autocomplete
+from eecont import benchmark
+from eecont import client
+from eecont import estimate
+from eecont import export
+from eecont import fields
 from eecont import inserter
 from eecont import models
+from eecont import nomenclature
+from eecont import snapshot
 from eecont import transform
+from eecont import validation
+from eecont import views
 
 
 def _dt(*args, **kwargs):
@@ -64,6 +93,11 @@ class TransformTestMixin(object):
         actual = self._func(self.input)
         self.assertEqual(self.expected, actual)
 
+    def test_input_untouched(self):
+        inp = self.input
+        self._func(inp)
+        self.assertEqual(self._input, inp)
+
 
 class CityTransformTest(TransformTestMixin, TestCase):
     _func = staticmethod(transform.cities)
@@ -427,6 +461,38 @@ class ZoneTransformTest(TestCase, TransformTestMixin):
         inp['id'] = 'bad'
         self.assertRaises(ValueError, transform.zones, inp)
 
+    def test_iterate(self):
+        inp = self.input
+        it = transform.iterate(transform.zones, inp)
+        self.assertEqual(self.expected[0], next(it))
+        self.assertEqual(1, len(inp))
+        self.assertEqual(self.expected[1:], list(it))
+        self.assertEqual([], inp)
+
+
+class ParseTest(TestCase):
+
+    def test_fast_datetime(self):
+        self.assertEqual(datetime.datetime(2013, 2, 18, 12, 13, 14),
+                         transform._fast_datetime('2013-02-18 12:13:14'))
+        self.assertIsNone(transform._fast_datetime('2010-9-15 7:15:30'))
+        self.assertIsNone(transform._fast_datetime('2013-02-30 12:13:14'))
+
+    def test_fast_time(self):
+        self.assertEqual(datetime.time(9, 30),
+                         transform._fast_time('09:30'))
+        self.assertEqual(datetime.time(9, 30, 15),
+                         transform._fast_time('09:30:15'))
+        self.assertIsNone(transform._fast_time('9:30'))
+
+    def test_memoized(self):
+        cache = transform._parse_updated_time.cache
+        cache.clear()
+        first = transform._updated_time('2010-12-8 22:33:44')
+        second = transform._updated_time('2010-12-8 22:33:44')
+        self.assertEqual(first, second)
+        self.assertEqual((1, 1), (cache.hits, cache.misses))
+
 
 ######################################
 # Test populating of related objects #
@@ -542,6 +608,20 @@ class PopulateRelationsTest(TestCase):
         inserter.populate_relations(data)
         self.assertEqual(expected_zone, data['zone'])
 
+    def test_resolver(self):
+        zone = self._create_zone()
+        resolver = inserter.RelationResolver()
+
+        data = resolver.resolve({'zone': zone.eid, 'name': 'Град'})
+        self.assertEqual({'zone_id': zone.pk, 'name': 'Град'}, data)
+
+        self.assertRaises(exceptions.ObjectDoesNotExist,
+                          resolver.resolve, {'zone': 31337})
+        self.assertEqual({'zone': set([31337])}, dict(resolver.missing))
+
+        resolver.report(verbosity=0)
+        self.assertFalse(resolver.missing)
+
 
 class InserterTest(TestCase):
 
@@ -602,6 +682,894 @@ class InserterTest(TestCase):
         for k, v in six.iteritems(data):
             self.assertEqual(v, getattr(city_obj, k))
 
+    def test_bulk_insert(self):
+        summary = inserter.bulk_insert(
+            [copy.deepcopy(self._zone)], 'Zone', 'eid', verbosity=0)
+        self.assertEqual((1, 0), (summary['inserted'], summary['updated']))
+
+        zone = copy.deepcopy(self._zone)
+        zone['name'] = 'Име2'
+        summary = inserter.bulk_insert(
+            [zone], 'Zone', 'eid', verbosity=0)
+        self.assertEqual((0, 1), (summary['inserted'], summary['updated']))
+
+        obj = models.Zone.objects.get(eid=self._zone['eid'])
+        self.assertEqual('Име2', obj.name)
+        self.assertEqual(1, models.Zone.objects.count())
+
+    def test_diff(self):
+        zone_obj = self._insert_zone()
+        city_obj = self._insert_city()
+
+        data = copy.deepcopy(self._city)
+        data['zone'] = zone_obj
+        self.assertEqual([], inserter.diff(city_obj, data))
+
+        data['zone_id'] = data.pop('zone').pk
+        data['ces_to_door'] = [1004]
+        data['service_days'] = [True] * 7
+        self.assertEqual(['ces_to_door', 'service_days'],
+                         sorted(inserter.diff(city_obj, data)))
+
+    def test_insert_unchanged(self):
+        self._insert_zone()
+        self.assertEqual('unchanged', inserter.insert(
+                copy.deepcopy(self._zone), 'Zone', 'eid', verbosity=0))
+
+        zone = copy.deepcopy(self._zone)
+        zone['national'] = False
+        self.assertEqual('updated', inserter.insert(
+                zone, 'Zone', 'eid', verbosity=0))
+
+    def test_filter_changed(self):
+        self._insert_zone()
+        old = copy.deepcopy(self._zone)
+        new = copy.deepcopy(self._zone)
+        new['eid'] = 1001
+
+        changed, skipped = inserter.filter_changed(
+            [old, new], models.Zone, 'eid')
+        self.assertEqual(([new], 1), (changed, skipped))
+
+        old['updated_time'] = _dt(2014, 1, 1, tz='Europe/Sofia')
+        changed, skipped = inserter.filter_changed(
+            [old], models.Zone, 'eid')
+        self.assertEqual(([old], 0), (changed, skipped))
+
+        changed, skipped = inserter.filter_changed(
+            [old], models.Zone, 'eid', old['updated_time'])
+        self.assertEqual(([], 1), (changed, skipped))
+
+    def test_watermark(self):
+        self.assertIsNone(inserter.get_watermark('zone'))
+        inserter.set_watermark('zone', self._zone['updated_time'])
+        self.assertEqual(self._zone['updated_time'],
+                         inserter.get_watermark('zone'))
+
+    def test_link_services(self):
+        self._insert_zone()
+        city = self._insert_city()
+        self.assertEqual(32, inserter.link_services(batch_size=5))
+        self.assertEqual(32, inserter.link_services())
+        self.assertEqual([1020, 1021], sorted(
+                models.ServiceLink.filter(city.service_links, 'cs', 'to',
+                                          'door')
+                .values_list('office_code', flat=True)))
+        self.assertEqual([(city.pk, 'cps', 'from', 'office')], list(
+                models.ServiceLink.objects.filter(office_code=1011)
+                .values_list('city', 'shipment', 'direction', 'kind')))
+        # The lists themselves are still there
+        self.assertEqual([1020, 1021],
+                         models.City.objects.get(pk=city.pk).cs_to_door)
+
+    def test_link_changed_services(self):
+        self._insert_zone()
+        city = self._insert_city()
+        inserter.link_services()
+        kept = set(city.service_links.values_list('pk', flat=True))
+
+        other = copy.deepcopy(self._city)
+        other.update(eid=2001, post_code=2006, cs_to_door=[1040])
+        changed = set()
+        summary = inserter.bulk_insert([copy.deepcopy(self._city), other],
+                                       models.City, 'eid', verbosity=0,
+                                       changed=changed)
+        self.assertEqual((1, 1), (summary['inserted'], summary['unchanged']))
+        self.assertEqual(set([2001]), changed)
+
+        self.assertEqual(31, inserter.link_services(eids=changed))
+        self.assertEqual(63, models.ServiceLink.objects.count())
+        # The links of the unchanged city were left alone
+        self.assertEqual(kept, set(city.service_links
+                                   .values_list('pk', flat=True)))
+        self.assertEqual([2001], list(
+                models.ServiceLink.objects.filter(office_code=1040)
+                .values_list('city__eid', flat=True)))
+
+    def test_service_offices(self):
+        self._insert_zone()
+        city = self._insert_city()
+        inserter.link_services()
+        midnight = datetime.time()
+        office = models.Office.objects.create(
+            eid=1, name='Офис', name_en='Office', office_code=1020,
+            time_priority=midnight, work_begin=midnight, work_end=midnight,
+            work_begin_saturday=midnight, work_end_saturday=midnight,
+            updated_time=self._city['updated_time'], address='', address_en='',
+            city_name=city.name, city_name_en=city.name_en, street_name='')
+
+        self.assertEqual([office], list(city.service_offices()))
+        self.assertEqual([office], list(city.service_offices('cs', 'to')))
+        self.assertEqual([], list(city.service_offices('cs', 'to',
+                                                       'office')))
+        self.assertEqual([city], list(office.served_cities(kind='door')))
+        self.assertEqual([], list(office.served_cities('ps')))
+
+    def test_lazy_fields(self):
+        self._insert_zone()
+        city = models.City.objects.get(pk=self._insert_city().pk)
+        self.assertIsInstance(city.__dict__['cs_to_door'], fields._Raw)
+        self.assertIsInstance(city.__dict__['service_days'], fields._Raw)
+        self.assertEqual([1020, 1021], city.cs_to_door)
+        self.assertIs(city.cs_to_door, city.cs_to_door)
+        self.assertIsInstance(city.__dict__['cs_from_door'], fields._Raw)
+        self.assertTrue(city.sd_thursday)
+
+        city.cs_to_door.append(1)
+        city.ps_to_door = '7,8'
+        self.assertEqual([7, 8], city.ps_to_door)
+        city.save()
+        city = models.City.objects.get(pk=city.pk)
+        self.assertEqual([1020, 1021, 1], city.cs_to_door)
+        self.assertEqual([7, 8], city.ps_to_door)
+
+    def test_deferred_save(self):
+        self._insert_zone()
+        pk = self._insert_city().pk
+        city = models.City.objects.defer('ces_to_door').get(pk=pk)
+        city.name = 'Град №2'
+        city.save()
+        city = models.City.objects.only('name', 'cs_to_door').get(pk=pk)
+        city.cs_to_door = [1]
+        city.save()
+
+        city = models.City.objects.get(pk=pk)
+        self.assertEqual('Град №2', city.name)
+        self.assertEqual([1], city.cs_to_door)
+        self.assertEqual([1004, 1005], city.ces_to_door)
+        self.assertEqual([1016, 1017], city.cs_from_door)
+
+
+class NomenclatureMixin(object):
+    """Store the zone and city of `InserterTest` for tests that need a
+    synced nomenclature.
+
+    """
+
+    def insert_city(self, streets=('ул. Дружба',)):
+        """Store the city, with `streets` numbered from 1, and return
+        it.
+
+        """
+        inserter.insert(copy.deepcopy(InserterTest._zone), 'Zone', 'eid')
+        inserter.insert(copy.deepcopy(InserterTest._city), 'City', 'eid')
+        for eid, name in enumerate(streets, 1):
+            inserter.insert({'eid': eid, 'name': name, 'name_en': '',
+                             'city': InserterTest._city['eid'],
+                             'updated_time': InserterTest._city['updated_time']},
+                            'Street', 'eid')
+        return models.City.objects.get(eid=InserterTest._city['eid'])
+
+
+class BenchmarkTest(TestCase):
+
+    def test_run(self):
+        sizes = {'zone': 2, 'city': 3, 'street': 5, 'office': 2}
+        results = benchmark.run(sizes)['results']
+        self.assertEqual(5, results['write.street']['records'])
+        self.assertEqual(5, models.Street.objects.count())
+        self.assertEqual(3 * 16, results['field.office_list.to_python']
+                         ['records'])
+
+
+class ClientPoolTest(TestCase):
+
+    def setUp(self):
+        self.pool = client.ClientPool(object, size=2, timeout=0.01)
+
+    def test_reuse(self):
+        with self.pool.client() as first:
+            pass
+        with self.pool.client() as second:
+            pass
+        self.assertIs(first, second)
+        self.assertEqual({'size': 2, 'created': 1, 'reused': 1},
+                         self.pool.stats())
+
+    def test_discard_on_error(self):
+        try:
+            with self.pool.client() as first:
+                raise ValueError()
+        except ValueError:
+            pass
+        with self.pool.client() as second:
+            self.assertIsNot(first, second)
+
+    def test_exhausted(self):
+        with self.pool.client(), self.pool.client():
+            with self.assertRaises(client.PoolExhausted):
+                with self.pool.client():
+                    pass
+
+
+class _FakeEcont(object):
+    """Stands in for `remoteecont.RemoteEcontXml` in `FetchTest`."""
+
+    raw = benchmark.generate({'zone': 2, 'city': 3, 'street': 5,
+                              'office': 2})
+    broken = None
+
+    def _get(self, name):
+        if name == self.broken:
+            raise IOError('Econt is down')
+        return copy.deepcopy(self.raw[name])
+
+    def cities_zones(self):
+        # Downloaded last, although it's inserted first
+        time.sleep(0.1)
+        return self._get('zone')
+
+    def cities(self):
+        return self._get('city')
+
+    def cities_streets(self):
+        return self._get('street')
+
+
+class FetchTest(TestCase):
+
+    def setUp(self):
+        self._factory = client.factory
+        client.factory = lambda *args: _FakeEcont
+
+    def tearDown(self):
+        client.factory = self._factory
+        _FakeEcont.broken = None
+
+    def _fetch(self, **kwargs):
+        return inserter.fetch_and_insert(
+            which=['zone', 'city', 'street'], verbosity=0, jobs=3, **kwargs)
+
+    def test_jobs(self):
+        summaries = self._fetch()
+        self.assertEqual(['zone', 'city', 'street'], list(summaries))
+        self.assertEqual([2, 3, 5], [s['inserted']
+                                     for s in summaries.values()])
+        self.assertEqual(5, models.Street.objects.count())
+
+    def test_relink(self):
+        self._fetch()
+        links = sorted(models.ServiceLink.objects.values_list('pk',
+                                                               flat=True))
+        self.assertTrue(links)
+        self._fetch()
+        self.assertEqual(links, sorted(models.ServiceLink.objects
+                                       .values_list('pk', flat=True)))
+
+    def test_quiet(self):
+        stdout, sys.stdout = sys.stdout, six.StringIO()
+        try:
+            self._fetch(batch_size=None)
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        self.assertEqual('', output)
+        self.assertTrue(models.ServiceLink.objects.exists())
+
+    def test_download_error(self):
+        _FakeEcont.broken = 'street'
+        self.assertRaises(IOError, self._fetch)
+
+
+_EECONT = {
+    'loading': {
+        'sender': {'city': 'София'},
+        'receiver': {'city': '', 'name': ''},
+        'shipment': {'weight': '1', 'description': ''},
+        'services': {'cd': {'type': 'GET', '__content__': '0'}}},
+    'system': {'validate': 1}}
+
+
+@override_settings(EECONT=_EECONT)
+class TemplateTest(TestCase):
+
+    def _loading(self, payment):
+        return eecont._loadings(
+            {'city': 'Ямбол', 'address': {'street': 'ул. Дружба'}},
+            {'weight': '2'}, {'payment': payment})[0]
+
+    def test_loading(self):
+        loading = self._loading(1250)
+        self.assertEqual({'city': 'София'}, loading['sender'])
+        self.assertEqual('Ямбол', loading['receiver']['city'])
+        self.assertEqual('ул. Дружба', loading['receiver']['street'])
+        self.assertEqual({'weight': '2', 'description': ''},
+                         loading['shipment'])
+        self.assertEqual({'type': 'GET', '__content__': '12.50'},
+                         loading['services']['cd'])
+
+    def test_template_untouched(self):
+        self._loading(1250)
+        self.assertEqual('0.0', self._loading(0)['services']['cd']
+                         ['__content__'])
+        self.assertEqual(_EECONT['loading']['services']['cd']['__content__'],
+                         '0')
+        self.assertEqual('', _EECONT['loading']['receiver']['city'])
+
+    def test_sections_copied(self):
+        loading = self._loading(1250)
+        loading['sender']['city'] = 'Ямбол'
+        loading['services']['cd']['type'] = 'POST'
+        loading = self._loading(0)
+        self.assertEqual({'city': 'София'}, loading['sender'])
+        self.assertEqual('GET', loading['services']['cd']['type'])
+
+    def test_system(self):
+        self.assertEqual({'validate': 0}, eecont._system(validate=0))
+        self.assertEqual({'validate': 1}, eecont._system())
+
+
+class ParseAddressTest(TestCase):
+
+    def setUp(self):
+        eecont.address_cache.clear()
+
+    def test_memoized(self):
+        first = eecont._parse_address('ул. Дружба 1')
+        first['street_other'] = 'changed'
+        second = eecont._parse_address('  ул.  Дружба 1 ')
+        self.assertNotIn('street_other', second)
+        self.assertEqual({'hits': 1, 'misses': 1, 'size': 1,
+                          'maxsize': eecont.address_cache.maxsize},
+                         eecont.address_cache.stats())
+
+    def test_original_address(self):
+        parsed = []
+        parse_address = eecont.parse_address
+        eecont.parse_address = lambda a: parsed.append(a) or {}
+        try:
+            eecont._parse_address('ул. Дружба 1\nвх. А')
+        finally:
+            eecont.parse_address = parse_address
+        self.assertEqual(['ул. Дружба 1\nвх. А'], parsed)
+
+
+class ResultsTest(TestCase):
+
+    def test_single(self):
+        response = {'result': {'e': {'error': ''}}}
+        self.assertEqual([{'error': ''}], eecont._results(response, 1))
+
+    def test_many(self):
+        response = {'result': {'e': [{'error': ''}, {'error': 'Грешка'}]}}
+        self.assertEqual([{'error': ''}, {'error': 'Грешка'}, None],
+                         eecont._results(response, 3))
+
+    def test_empty(self):
+        self.assertEqual([None, None], eecont._results({}, 2))
+
+    def test_truncated(self):
+        response = {'result': {'e': [{'error': ''}, {'error': 'Грешка'}]}}
+        self.assertEqual([{'error': ''}], eecont._results(response, 1))
+
+
+class StubRequestMixin(object):
+    """Replace `eecont._generic_request` with `fake_request`, which
+    answers each loading with an <e> element that echoes the receiver's
+    name, and fails for receivers named 'fail'.
+
+    """
+
+    def setUp(self):
+        self.requests = []
+        self._generic_request = eecont._generic_request
+        eecont._generic_request = self.fake_request
+
+    def tearDown(self):
+        eecont._generic_request = self._generic_request
+
+    def fake_request(self, address, shipment, services=None, system=None):
+        self.requests.append(address)
+        many = isinstance(address, list)
+        names = [a['name'] for a in (address if many else [address])]
+        if 'fail' in names:
+            raise IOError('Econt is down')
+        results = [{'error': '', 'name': n} for n in names]
+        return {'result': {'e': results if many else results[0]}}
+
+
+class ShipmentRequestManyTest(StubRequestMixin, TestCase):
+
+    def _orders(self, *names):
+        return [{'address': {'name': n}, 'shipment': {'weight': '1'}}
+                for n in names]
+
+    def test_chunks(self):
+        ret = eecont.shipment_request_many(
+            self._orders('a', 'b', 'c', 'd', 'e'), chunk_size=2)
+        self.assertEqual([2, 2, 1], [len(r) for r in self.requests])
+        self.assertEqual(['a', 'b', 'c', 'd', 'e'],
+                         [r['result']['name'] for r in ret])
+        self.assertEqual([None] * 5, [r['error'] for r in ret])
+
+    def test_failed_chunk(self):
+        ret = eecont.shipment_request_many(
+            self._orders('a', 'b', 'fail', 'd', 'e'), chunk_size=2)
+        self.assertEqual([None, None, 'Econt is down', 'Econt is down',
+                          None], [r['error'] for r in ret])
+        self.assertEqual(['a', 'b', None, None, 'e'],
+                         [r['result'] and r['result']['name'] for r in ret])
+
+
+@override_settings(EECONT=dict(
+        _EECONT, login={'service_url': '', 'parcel_url': '', 'username': '',
+                        'password': ''},
+        pool={'size': 2}, local_validation=False,
+        defaults={'delivery_cost': 999, 'delivery_date': None}))
+class AsyncTest(StubRequestMixin, TestCase):
+
+    _address = {'name': 'Иван', 'city': 'София'}
+    _shipment = {'weight': '1'}
+
+    def setUp(self):
+        super(AsyncTest, self).setUp()
+        self.active = self.most = 0
+        self.lock = threading.Lock()
+        self._pools = client._pool, eecont._workers
+        client._pool = eecont._workers = None
+
+    def tearDown(self):
+        super(AsyncTest, self).tearDown()
+        if eecont._workers is not None:
+            eecont._workers.terminate()
+        client._pool, eecont._workers = self._pools
+
+    def fake_request(self, *args, **kwargs):
+        with self.lock:
+            self.active += 1
+            self.most = max(self.most, self.active)
+        time.sleep(0.02)
+        with self.lock:
+            self.active -= 1
+        return super(AsyncTest, self).fake_request(*args, **kwargs)
+
+    def test_shipment_request(self):
+        self.assertEqual(
+            eecont.shipment_request(self._address, self._shipment, {}),
+            eecont.ashipment_request(self._address, self._shipment,
+                                     {}).get(1))
+
+    def test_delivery_info(self):
+        self.assertEqual(
+            eecont.delivery_info(self._address, self._shipment, {}),
+            eecont.adelivery_info(self._address, self._shipment, {}).get(1))
+
+    def test_validate_address(self):
+        self.assertEqual(eecont.validate_address(self._address),
+                         eecont.avalidate_address(self._address).get(1))
+
+    def test_bounded(self):
+        pending = [eecont.adelivery_info(self._address, self._shipment, {})
+                   for _ in range(6)]
+        for p in pending:
+            p.get(1)
+        self.assertEqual(2, self.most)
+
+
+class QuoteKeyTest(TestCase):
+
+    def test_normalized(self):
+        a, wa = eecont._quote_key({'city': ' София ', 'post_code': '1000'},
+                                  {'weight': '0.3'}, {'payment': 100}, 0.5)
+        b, wb = eecont._quote_key({'city': 'софия', 'post_code': 1000,
+                                   'address': 'ул. Някоя 1'},
+                                  {'weight': 0.5}, {'payment': '100'}, 0.5)
+        self.assertEqual(a, b)
+        self.assertEqual(('0.5', '0.5'), (wa, wb))
+
+    def test_different(self):
+        a, _ = eecont._quote_key({'city': 'София'}, {'weight': 1},
+                                 {'payment': 100}, 0.5)
+        b, _ = eecont._quote_key({'city': 'София'}, {'weight': 1},
+                                 {'payment': 200}, 0.5)
+        self.assertNotEqual(a, b)
+
+    def test_uncacheable(self):
+        self.assertEqual((None, None), eecont._quote_key(
+                [{'city': 'София'}], [{'weight': 1}], [{}], 0.5))
+
+
+class QuoteCacheTest(TestCase):
+
+    def setUp(self):
+        self.calls = 0
+        self.quotes = []
+        self._quote = eecont._quote
+        eecont._quote = self.fake_quote
+        get_cache('default').clear()
+
+    def tearDown(self):
+        eecont._quote = self._quote
+
+    def fake_quote(self, address, shipment, services):
+        self.calls += 1
+        return self.quotes.pop(0)
+
+    def _info(self):
+        return eecont.delivery_info({'city': 'София'}, {'weight': '1'},
+                                    {'payment': 0})
+
+    def _settings(self, **conf):
+        conf.setdefault('backend', 'default')
+        return self.settings(EECONT=dict(
+                _EECONT, quote_cache=conf,
+                defaults={'delivery_cost': 999, 'delivery_date': None}))
+
+    def test_hit(self):
+        self.quotes = [(1250, '2013-01-02')]
+        with self._settings():
+            self.assertEqual({'cost': 1250, 'date': '2013-01-02'},
+                             self._info())
+            self.assertEqual({'cost': 1250, 'date': '2013-01-02'},
+                             self._info())
+        self.assertEqual(1, self.calls)
+
+    def test_failure_not_cached(self):
+        self.quotes = [(None, None), (1250, None)]
+        with self._settings():
+            self.assertEqual(999, self._info()['cost'])
+            self.assertEqual(1250, self._info()['cost'])
+        self.assertEqual(2, self.calls)
+
+    def _wait(self, calls):
+        for _ in range(100):
+            if self.calls >= calls:
+                break
+            time.sleep(0.01)
+        # Let the revalidating thread store the quote
+        time.sleep(0.05)
+
+    def test_stale(self):
+        self.quotes = [(1250, None), (1300, None), (1300, None)]
+        with self._settings(timeout=0):
+            self.assertEqual(1250, self._info()['cost'])
+            # Served stale while revalidating in the background
+            self.assertEqual(1250, self._info()['cost'])
+            self._wait(2)
+            self.assertEqual(1300, self._info()['cost'])
+            self._wait(3)
+        self.assertEqual(3, self.calls)
+
+
+class SnapshotTest(TestCase):
+
+    _data = [{'id': '1000', 'name': 'Име1', 'service_days': {'day1': '1'}}]
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_roundtrip(self):
+        snapshot.save(self.directory, 'city', self._data, '2013-01-01')
+        self.assertEqual(self._data,
+                         snapshot.load(self.directory, 'city', '2013-01-01'))
+
+    def test_latest(self):
+        snapshot.save(self.directory, 'city', [], '2013-01-01')
+        snapshot.save(self.directory, 'city', self._data, '2013-01-02')
+        snapshot.save(self.directory, 'zone', [], '2013-01-03')
+        self.assertEqual(self._data, snapshot.load(self.directory, 'city'))
+
+    def test_missing(self):
+        self.assertRaises(IOError, snapshot.load, self.directory, 'city')
+
+    def test_latest_common(self):
+        snapshot.save(self.directory, 'city', [], '2013-01-01')
+        snapshot.save(self.directory, 'street', [], '2013-01-01')
+        snapshot.save(self.directory, 'city', [], '2013-01-02')
+        self.assertEqual('2013-01-01', snapshot.latest(self.directory,
+                                                       ['city', 'street']))
+        self.assertRaises(IOError, snapshot.latest, self.directory,
+                          ['city', 'zone'])
+
+    def test_concurrent_save(self):
+        names = ['zone', 'country', 'city', 'quarter', 'street', 'office']
+        pool = ThreadPool(len(names))
+        try:
+            pool.map(lambda n: snapshot.save(self.directory, n, [],
+                                             '2013-01-01'), names)
+        finally:
+            pool.close()
+        self.assertEqual('2013-01-01', snapshot.latest(self.directory,
+                                                       names))
+
+
+@override_settings(EECONT={'defaults': {'delivery_cost': 999,
+                                        'delivery_date': None}})
+class EstimateTest(NomenclatureMixin, TestCase):
+
+    def setUp(self):
+        self.insert_city(())
+        zone = models.Zone.objects.get()
+        models.Tariff.objects.create(zone=zone, weight=1, cod=0, cost=450)
+        models.Tariff.objects.create(zone=zone, weight=2, cod=5000, cost=620)
+        estimate._zones.clear()
+        estimate._table.invalidate()
+
+    def _cost(self, address, weight, payment):
+        return estimate.estimate_delivery(
+            address, {'weight': weight}, {'payment': payment})['cost']
+
+    def test_estimate(self):
+        self.assertEqual(450, self._cost({'post_code': 2005}, '0.5', 0))
+        self.assertEqual(620, self._cost({'city': 'Град №1'}, '1.5', 1000))
+
+    def test_default(self):
+        self.assertEqual(999, self._cost({'post_code': 2005}, '3', 0))
+        self.assertEqual(999, self._cost({'post_code': 1}, '1', 0))
+        self.assertEqual(999, self._cost({}, '1', 0))
+
+    def test_synced(self):
+        self.assertEqual(450, self._cost({'post_code': 2005}, '0.5', 0))
+        models.City.objects.all().delete()
+        nomenclature.bump()
+        self.assertEqual(999, self._cost({'post_code': 2005}, '0.5', 0))
+
+
+class ValidationTest(NomenclatureMixin, TestCase):
+
+    def setUp(self):
+        self.insert_city()
+        validation._names.clear()
+
+    def _validate(self, post_code, street):
+        return validation.validate_locally(
+            {'post_code': post_code, 'address': {'street': street}})
+
+    def test_normalize(self):
+        self.assertEqual('дружба', validation.normalize(' Ул.  Дружба'))
+        self.assertEqual('цар освободител',
+                         validation.normalize('бул. "Цар Освободител"'))
+        self.assertEqual('младост 1', validation.normalize('ж.к. Младост 1'))
+
+    def test_valid(self):
+        self.assertEqual((True, None), self._validate(2005, 'улица Дружба'))
+
+    def test_unknown_city(self):
+        self.assertEqual((True, validation.CITY_NOT_FOUND),
+                         self._validate(1, 'ул. Дружба'))
+
+    def test_undecided(self):
+        self.assertEqual((False, None), self._validate(2005, 'ул. Друга'))
+
+    def test_synced(self):
+        self.assertEqual((True, None), self._validate(2005, 'ул. Дружба'))
+        models.Street.objects.all().delete()
+        nomenclature.bump()
+        self.assertEqual((False, None), self._validate(2005, 'ул. Дружба'))
+
+    def _validate_city(self, city):
+        return validation.validate_locally(
+            {'city': city, 'address': {'street': 'ул. Дружба'}})
+
+    def test_city_name(self):
+        for name in ['Град №1', ' Град  №1 ', 'гр. Град №1']:
+            self.assertEqual((True, None), self._validate_city(name))
+
+    def test_unknown_city_name(self):
+        # Never final, Econt is asked instead
+        self.assertEqual((False, None), self._validate_city('Друг град'))
+        self.assertNotEqual(validation.CITY_NOT_FOUND,
+                            self._validate_city('град №1')[1])
+
+
+class AutocompleteTest(NomenclatureMixin, TestCase):
+
+    def test_search(self):
+        index = autocomplete.PrefixIndex([('София', 'Sofia'),
+                                          ('Сопот', 'Sopot'),
+                                          ('София', 'Sofia'),
+                                          ('Ямбол', '')])
+        self.assertEqual([{'name': 'Сопот', 'count': 1},
+                          {'name': 'София', 'count': 2}],
+                         index.search('СО'))
+        self.assertEqual([{'name': 'София', 'count': 2}],
+                         index.search('sof'))
+        self.assertEqual([{'name': 'Сопот', 'count': 1}],
+                         index.search('с', limit=1))
+        self.assertEqual([], index.search('x'))
+
+    def test_invalidate(self):
+        autocomplete.invalidate()
+        self.assertEqual([], autocomplete.search(models.City, 'Я'))
+        self.insert_city(())
+        self.assertEqual([], autocomplete.search(models.City, 'Я'))
+        autocomplete.invalidate()
+        self.assertEqual([{'name': InserterTest._city['name'], 'count': 1}],
+                         autocomplete.search(models.City,
+                                             InserterTest._city['name'][:2]))
+
+    def test_concurrent_build(self):
+        self.insert_city(())
+        autocomplete.invalidate()
+        started, release = threading.Event(), threading.Event()
+        released = []
+        names = autocomplete._names
+
+        def slow_names(model, city):
+            if model is not models.Street:
+                return names(model, city)
+            started.set()
+            released.append(release.wait(5))
+            return models.Street.objects.none()
+
+        autocomplete._names = slow_names
+        nomenclature.version()
+        builder = threading.Thread(target=autocomplete.index,
+                                   args=(models.Street,))
+        try:
+            builder.start()
+            self.assertTrue(started.wait(5))
+            # Not held up by the street index being built
+            self.assertEqual(1, len(autocomplete.index(models.City)))
+        finally:
+            release.set()
+            builder.join()
+            autocomplete._names = names
+        # The build was still waiting, rather than timed out
+        self.assertEqual([True], released)
+        self.assertEqual(0, len(autocomplete.index(models.Street)))
+
+    def test_city_filter(self):
+        self.insert_city()
+        autocomplete.invalidate()
+        city = models.City.objects.get()
+        self.assertEqual(city.pk, autocomplete.city_id(city.eid))
+        self.assertEqual(city.pk, autocomplete.city_id(None, city.post_code))
+        self.assertIsNone(autocomplete.city_id(None, 'junk'))
+        self.assertEqual([{'name': 'ул. Дружба', 'count': 1}],
+                         autocomplete.search(models.Street, 'ул',
+                                             city=city.pk))
+        self.assertEqual([], autocomplete.search(models.Street, 'ул',
+                                                 city=city.pk + 1))
+
+    def test_city_index(self):
+        # Plain SQL, the same for SQLite and PostgreSQL
+        for model in (models.Quarter, models.Street):
+            ddl = connection.creation.sql_indexes_for_model(model,
+                                                           no_style())
+            self.assertTrue(any('("city_id", "name")' in sql for sql in ddl))
+
+    @skipUnless(connection.vendor == 'sqlite', 'SQLite query plan')
+    def test_city_query_plan(self):
+        sql, params = autocomplete._names(models.Street, 1)\
+                                  .query.sql_with_params()
+        cursor = connection.cursor()
+        cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+        plan = ' '.join(row[-1] for row in cursor.fetchall())
+        self.assertIn('(city_id=?)', plan)
+        self.assertIn('USING INDEX', plan)
+        # The index is ordered by name too
+        self.assertNotIn('TEMP B-TREE', plan)
+
+    @skipUnless(connection.vendor == 'postgresql', 'PostgreSQL query plan')
+    def test_city_query_plan_postgresql(self):
+        sql, params = autocomplete._names(models.Street, 1)\
+                                  .query.sql_with_params()
+        cursor = connection.cursor()
+        cursor.execute('SET enable_seqscan = off')
+        cursor.execute('SET enable_bitmapscan = off')
+        cursor.execute('EXPLAIN ' + sql, params)
+        plan = ' '.join(row[0] for row in cursor.fetchall())
+        self.assertIn('Index', plan)
+        self.assertNotIn('Sort', plan)
+
+
+class JsonpCacheTest(NomenclatureMixin, TestCase):
+
+    def setUp(self):
+        self.factory = RequestFactory()
+
+    def _get(self, etag=None):
+        request = self.factory.get('/', {'query': 'с', 'callback': 'cb'})
+        if etag:
+            request.META['HTTP_IF_NONE_MATCH'] = etag
+        return views.city_list(request)
+
+    def test_bump(self):
+        nomenclature.bump()
+        version = nomenclature.version()
+        self.assertEqual(version, nomenclature.version())
+        nomenclature.bump()
+        self.assertNotEqual(version, nomenclature.version())
+
+    def test_not_modified(self):
+        resp = self._get()
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual(b'cb([]);', resp.content)
+        self.assertIn('max-age=', resp['Cache-Control'])
+        self.assertEqual(304, self._get(resp['ETag']).status_code)
+        nomenclature.bump()
+        self.assertEqual(200, self._get(resp['ETag']).status_code)
+
+    @override_settings(EECONT=dict(_EECONT, http_cache={'backend': 'default'}))
+    def test_response_cache(self):
+        self.assertEqual(b'cb([]);', self._get().content)
+        with self.assertNumQueries(0):
+            self.assertEqual(b'cb([]);', self._get().content)
+
+    def test_streaming(self):
+        self.insert_city(['ул. 1', 'ул. 2', 'ул. 3'])
+        request = self.factory.get('/', {'callback': 'cb', 'city': 2000})
+        view = views.StreetList.as_view(chunk_size=2)
+        chunks = list(view(request).streaming_content)
+        self.assertEqual(4, len(chunks))
+        content = b''.join(chunks).decode('utf-8')
+        self.assertTrue(content.startswith('cb(') and content.endswith(');'))
+        self.assertEqual([{'eid': e, 'name': 'ул. {}'.format(e),
+                           'name_en': ''} for e in range(1, 4)],
+                         sorted(json.loads(content[3:-2]),
+                                key=lambda r: r['eid']))
+
+
+class ExportTest(NomenclatureMixin, TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.insert_city()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _dump(self, name, city=None, encoding=''):
+        request = RequestFactory().get('/', HTTP_ACCEPT_ENCODING=encoding)
+        with self.settings(EECONT=dict(_EECONT, export_dir=self.directory)):
+            return views.dump(request, name, city)
+
+    def test_build(self):
+        self.assertIsNone(export.current(self.directory))
+        version = export.build(self.directory)
+        self.assertEqual(version, export.current(self.directory))
+        with open(export.path(self.directory, 'streets', 2000)) as f:
+            self.assertEqual([{'eid': 1, 'name': 'ул. Дружба',
+                               'name_en': ''}],
+                             json.loads(f.read().decode('utf-8')))
+        with open(export.path(self.directory, 'quarters', 2000)) as f:
+            self.assertEqual([], json.loads(f.read().decode('utf-8')))
+
+    def test_build_cleanup(self):
+        for name in ('0123456789abcdef', '0123456789abcdef.tmp',
+                     'unrelated'):
+            os.makedirs(os.path.join(self.directory, name))
+        version = export.build(self.directory)
+        self.assertEqual(sorted([export.CURRENT, version, 'unrelated']),
+                         sorted(os.listdir(self.directory)))
+
+    def test_dump(self):
+        export.build(self.directory)
+        resp = self._dump('streets', encoding='gzip, deflate')
+        self.assertEqual('gzip', resp['Content-Encoding'])
+        self.assertIn('Accept-Encoding', resp['Vary'])
+        raw = gzip.GzipFile(fileobj=six.BytesIO(
+                b''.join(resp.streaming_content))).read()
+        self.assertEqual(2000, json.loads(raw.decode('utf-8'))[0]['city'])
+
+        resp = self._dump('streets', encoding='gzip;q=0')
+        self.assertFalse(resp.has_header('Content-Encoding'))
+        self.assertRaises(http.Http404, self._dump, 'streets', 1)
+
 
 class OfficeDefaultsTest(TestCase):
 
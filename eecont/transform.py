@@ -14,6 +14,10 @@ from django.utils import timezone
 
 import pytz
 
+from eecont import cache
+
+SOFIA = pytz.timezone('Europe/Sofia')
+
 CITY_FIELDS = ['eid', 'zone', 'name', 'name_en', 'post_code', 'service_days',
                'is_village', 'updated_time',
                'ces_from_door', 'ces_to_door', 'ces_from_office',
@@ -38,21 +42,25 @@ STREET_FIELDS = ['eid', 'name', 'name_en', 'city', 'updated_time']
 ZONE_FIELDS = ['eid', 'is_ee', 'name', 'name_en', 'national', 'updated_time']
 
 
-def _address_details(d):
-    d = d.get('address_details', d)
-
-    # Copy these keys
-    ret = {k: d[k] for k in ['other', 'quarter_name', 'street_name']}
+def _fast_time(val):
+    """Parse the common `HH:MM` and `HH:MM:SS` shapes without a regex.
+    Return None if `val` has any other shape.
 
-    # And transform these
-    ret['apartment_building'] = d.get('bl')
-    ret['entrance'] = d.get('vh')
-    ret['floor'] = d.get('et')
-    ret['apartment'] = d.get('ap')
-    ret['number'] = d.get('num')
-    return ret
+    """
+    if len(val) not in (5, 8) or val[2] != ':' or \
+       (len(val) == 8 and val[5] != ':'):
+        return None
+    parts = val.split(':')
+    if not all(p.isdigit() for p in parts):
+        return None
+    try:
+        return datetime.time(*[int(p) for p in parts])
+    except ValueError:
+        # Let the regular parser complain
+        return None
 
 
+@cache.memoize(256)
 def _time(val, default=None):
     if not val:
         val = ''
@@ -61,7 +69,10 @@ def _time(val, default=None):
     if val[:2] == '24':
         val = '23:59'
 
-    ret = None
+    ret = _fast_time(val)
+    if ret is not None:
+        return ret
+
     try:
         ret = dateparse.parse_time(val)
     except ValueError as e:
@@ -75,11 +86,34 @@ def _time(val, default=None):
     return None
 
 
+def _fast_datetime(value):
+    """Parse the common `YYYY-MM-DD HH:MM:SS` shape without a regex.
+    Return None if `value` has any other shape.
+
+    """
+    if len(value) != 19 or value[4] != '-' or value[7] != '-' or \
+       value[10] != ' ' or value[13] != ':' or value[16] != ':':
+        return None
+    digits = (value[0:4], value[5:7], value[8:10],
+              value[11:13], value[14:16], value[17:19])
+    if not all(d.isdigit() for d in digits):
+        return None
+    try:
+        return datetime.datetime(*[int(d) for d in digits])
+    except ValueError:
+        return None
+
+
 def _updated_time(value):
+    return _parse_updated_time(value, settings.USE_TZ)
+
+
+@cache.memoize(4096)
+def _parse_updated_time(value, use_tz):
     try:
-        dt = dateparse.parse_datetime(value)
-        if settings.USE_TZ and not timezone.is_aware(dt):
-            dt = timezone.make_aware(dt, pytz.timezone('Europe/Sofia'))
+        dt = _fast_datetime(value) or dateparse.parse_datetime(value)
+        if use_tz and not timezone.is_aware(dt):
+            dt = timezone.make_aware(dt, SOFIA)
         return dt
     except ValueError:
         # Just return a date that's really long in the past
@@ -107,12 +141,123 @@ def _attach_offices(data, tag1, tag2):
     return [int(s) for s in res]
 
 
-def _clean(dct, keys):
-    """Remove all keys in `dct` that are not found in `keys`."""
+def _details(d):
+    return d.get('address_details', d)
+
+
+class TransformSpec(object):
+    """A precompiled transformation of a single Econt record.
+
+    `converters` is a sequence of `(key, func)` pairs: `func` receives
+    the raw record and returns the value of `key` in the result.  The
+    rest of the `fields` are copied as they are, provided they're
+    present in the raw record.  Anything else is left out.
+
+    """
+
+    def __init__(self, fields, converters):
+        self.converters = tuple(converters)
+        self.keys = frozenset(fields)
+        self.copied = tuple(self.keys - frozenset(k for k, _ in converters))
+
+    def __call__(self, record):
+        ret = dict((k, record[k]) for k in self.copied if k in record)
+        for key, func in self.converters:
+            ret[key] = func(record)
+        return ret
+
+    def transform(self, data):
+        if not isinstance(data, list):
+            data = [data]
+        return [self(record) for record in data]
+
 
-    # Remove unwanted keys
-    for k in [e for e in six.iterkeys(dct) if e not in keys]:
-        del dct[k]
+def _int(key):
+    return lambda d: int(d[key])
+
+
+def _flag(key):
+    return lambda d: d[key] == '1'
+
+
+def _timestamp(key):
+    return lambda d: _updated_time(d[key])
+
+
+def _clock(key):
+    return lambda d: _time(d[key], '0:0')
+
+
+def _office_list(tag1, tag2):
+    return lambda d: _attach_offices(d, tag1, tag2)
+
+
+def _detail(key, default=False):
+    if default:
+        return lambda d: _details(d).get(key)
+    return lambda d: _details(d)[key]
+
+
+_SHIPMENT_TAGS = [('ces', 'cargo_expres_shipments'),
+                  ('cps', 'cargo_palet_shipments'),
+                  ('cs',  'courier_shipments'),
+                  ('ps',  'post_shipments')]
+
+CITY = TransformSpec(CITY_FIELDS, [
+    ('eid',          _int('id')),
+    ('is_village',   lambda d: d['type'] == 'с.'),
+    ('post_code',    _int('post_code')),
+    ('service_days', lambda d: _service_days(d['service_days'])),
+    ('updated_time', _timestamp('updated_time')),
+    ('zone',         _int('id_zone'))] + [
+    # Office codes
+    ('{}_{}_{}'.format(prefix, seg1, seg2),
+     _office_list(tag1, '{}_{}'.format(seg1, seg2)))
+    for prefix, tag1 in _SHIPMENT_TAGS
+    for seg1 in ['from', 'to']
+    for seg2 in ['door', 'office']])
+
+COUNTRY = TransformSpec(COUNTRY_FILEDS, [
+    ('name',    lambda d: d['country_name']),
+    ('name_en', lambda d: d['country_name_en']),
+    ('zone',    _int('id_zone'))])
+
+# Leave the following fields as they are: address, address_en,
+# city_name, city_name_en, name, name_en, phone, latitude, longitude
+OFFICE = TransformSpec(OFFICE_FIELDS, [
+    ('other',               _detail('other')),
+    ('quarter_name',        _detail('quarter_name')),
+    ('street_name',         _detail('street_name')),
+    ('apartment_building',  _detail('bl', default=True)),
+    ('entrance',            _detail('vh', default=True)),
+    ('floor',               _detail('et', default=True)),
+    ('apartment',           _detail('ap', default=True)),
+    ('number',              _detail('num', default=True)),
+    ('eid',                 _int('id')),
+    ('office_code',         _int('office_code')),
+    ('updated_time',        _timestamp('updated_time')),
+    ('time_priority',       _clock('time_priority')),
+    ('work_begin',          _clock('work_begin')),
+    ('work_begin_saturday', _clock('work_begin_saturday')),
+    ('work_end',            _clock('work_end')),
+    ('work_end_saturday',   _clock('work_end_saturday'))])
+
+REGION = TransformSpec(REGION_FIELDS, [
+    ('eid',          _int('id')),
+    ('code',         _int('code')),
+    ('city',         _int('id_city')),
+    ('updated_time', _timestamp('updated_time'))])
+
+STREET = TransformSpec(STREET_FIELDS, [
+    ('eid',          _int('id')),
+    ('city',         _int('id_city')),
+    ('updated_time', _timestamp('updated_time'))])
+
+ZONE = TransformSpec(ZONE_FIELDS, [
+    ('eid',          _int('id')),
+    ('is_ee',        _flag('is_ee')),
+    ('national',     _flag('national')),
+    ('updated_time', _timestamp('updated_time'))])
 
 
 ##############
@@ -120,69 +265,30 @@ def _clean(dct, keys):
 ##############
 
 def cities(data):
-    if not isinstance(data, list):
-        data = [data]
-
-    tags = {
-        'ces': 'cargo_expres_shipments',
-        'cps': 'cargo_palet_shipments',
-        'cs' : 'courier_shipments',
-        'ps' : 'post_shipments'}
-
-    for city in data:
-        city['eid'] = int(city.pop('id'))
-        city['is_village'] = city.pop('type') == 'с.'
-        city['post_code'] = int(city['post_code'])
-        city['service_days'] = _service_days(city['service_days'])
-        city['updated_time'] = _updated_time(city['updated_time'])
-        city['zone'] = int(city.pop('id_zone'))
-
-        # Office codes
-        for prefix, tag1 in six.iteritems(tags):
-            for seg1 in ['from', 'to']:
-                for seg2 in ['door', 'office']:
-                    tag2 = '{}_{}'.format(seg1, seg2)
-                    key = '{}_{}'.format(prefix, tag2)
-                    city[key] = _attach_offices(city, tag1, tag2)
-
-        _clean(city, CITY_FIELDS)
-    return data
+    return CITY.transform(data)
 
 
 def countries(data):
-    if not isinstance(data, list):
-        data = [data]
-    for country in data:
-        country['name'] = country.pop('country_name')
-        country['name_en'] = country.pop('country_name_en')
-        country['zone'] = int(country.pop('id_zone'))
-        _clean(country, COUNTRY_FILEDS)
-    return data
+    return COUNTRY.transform(data)
+
+
+def iterate(func, data):
+    """Lazily apply the transformation `func` (e.g. `cities`) to each
+    record in the list `data`.
+
+    The list is consumed: every record is removed from it before being
+    yielded, so records that were already processed can be garbage
+    collected as soon as the caller is done with them.
+
+    """
+    data.reverse()
+    while data:
+        for record in func(data.pop()):
+            yield record
 
 
 def offices(data):
-    if not isinstance(data, list):
-        data = [data]
-    for o in data:
-        # Leave the following fields as they are:
-        # address, address_en, city_name, city_name_en, name, name_en,
-        # phone
-
-        o.update(_address_details(o))
-        o['eid'] = int(o['id'])
-        o['latitude'] = o['latitude']
-        o['longitude'] = o['longitude']
-        o['office_code'] = int(o['office_code'])
-        o['updated_time'] = _updated_time(o['updated_time'])
-
-        o['time_priority']       = _time(o['time_priority']      , '0:0')
-        o['work_begin']          = _time(o['work_begin']         , '0:0')
-        o['work_begin_saturday'] = _time(o['work_begin_saturday'], '0:0')
-        o['work_end']            = _time(o['work_end']           , '0:0')
-        o['work_end_saturday']   = _time(o['work_end_saturday']  , '0:0')
-        _clean(o, OFFICE_FIELDS)
-        # _populate_missing(o, OFFICE_DEFAULTS)
-    return data
+    return OFFICE.transform(data)
 
 
 def quarters(data):
@@ -191,35 +297,12 @@ def quarters(data):
 
 
 def regions(data):
-    if not isinstance(data, list):
-        data = [data]
-    for rgn in data:
-        rgn['eid'] = int(rgn.pop('id'))
-        rgn['code'] = int(rgn.pop('code'))
-        rgn['city'] = int(rgn.pop('id_city'))
-        rgn['updated_time'] = _updated_time(rgn['updated_time'])
-        _clean(rgn, REGION_FIELDS)
-    return data
+    return REGION.transform(data)
 
 
 def streets(data):
-    if not isinstance(data, list):
-        data = [data]
-    for street in data:
-        street['eid'] = int(street.pop('id'))
-        street['city'] = int(street['id_city'])
-        street['updated_time'] = _updated_time(street['updated_time'])
-        _clean(street, STREET_FIELDS)
-    return data
+    return STREET.transform(data)
 
 
 def zones(data):
-    if not isinstance(data, list):
-        data = [data]
-    for zone in data:
-        zone['eid'] = int(zone.pop('id'))
-        zone['is_ee'] = zone['is_ee'] == '1'
-        zone['national'] = zone['national'] == '1'
-        zone['updated_time'] = _updated_time(zone['updated_time'])
-        _clean(zone, ZONE_FIELDS)
-    return data
+    return ZONE.transform(data)
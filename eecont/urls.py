@@ -12,4 +12,9 @@ urlpatterns = patterns(
     url(r'^quarters/$', 'quarter_list', name='eecont-quarter-list-jsonp'),
     url(r'^streets/$', 'street_list', name='eecont-street-list-jsonp'),
 
+    url(r'^export/(?P<name>cities|quarters|streets)/$', 'dump',
+        name='eecont-dump'),
+    url(r'^export/(?P<name>quarters|streets)/(?P<city>\d+)/$', 'dump',
+        name='eecont-city-dump'),
+
 )
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+"""Address validation against the locally synced City, Quarter and
+Street tables, so that `eecont.validate_address` only has to ask Econt
+when the local data can't decide.
+
+"""
+
+from __future__ import unicode_literals
+
+import re
+
+from django.utils import six
+
+import eecont
+from eecont import cache
+from eecont import models
+from eecont import nomenclature
+
+
+CITY_NOT_FOUND = 'Не е намерено населено място с този пощенски код.'
+
+_PREFIX_RE = re.compile(
+    r'^(ул|улица|бул|булевард|пл|площад|ж\.?\s?к|кв|квартал)\b\.?\s*',
+    re.UNICODE)
+_JUNK_RE = re.compile(r'[.,"„“\'-]+', re.UNICODE)
+_SPACE_RE = re.compile(r'\s+', re.UNICODE)
+
+
+def normalize(name):
+    """Case fold `name` and strip it of its type prefix ("ул.", "бул.",
+    "ж.к.", ...), punctuation and redundant whitespace.
+
+    """
+    name = _SPACE_RE.sub(' ', six.text_type(name or '').strip().lower())
+    name = _PREFIX_RE.sub('', name)
+    name = _JUNK_RE.sub(' ', name)
+    return _SPACE_RE.sub(' ', name).strip()
+
+
+# (nomenclature version, city pk) ->
+#     (frozenset of street names, frozenset of quarter names)
+_names = cache.LRUCache(512)
+
+
+def _city_names(city_id):
+    key = (nomenclature.version(), city_id)
+    names = _names.get(key)
+    if names is None:
+        names = tuple(
+            frozenset(normalize(n) for n in model.objects.filter(
+                    city_id=city_id).values_list('name', flat=True))
+            for model in (models.Street, models.Quarter))
+        _names.set(key, names)
+    return names
+
+
+_CITY_PREFIX_RE = re.compile(r'^(гр|с)\.\s*', re.UNICODE | re.IGNORECASE)
+
+
+def _city_name(name):
+    """Strip `name` of redundant whitespace and its "гр." or "с."."""
+    name = _SPACE_RE.sub(' ', six.text_type(name).strip())
+    return _CITY_PREFIX_RE.sub('', name)
+
+
+def validate_locally(address):
+    """Validate `address` (see `eecont.validate_address`) against the
+    synced tables.  Return a `(decided, error)` tuple: `decided` is
+    False if the local data isn't enough and Econt should be asked.
+
+    Only an unknown post code is treated as an error.  A city name, a
+    street or a quarter that isn't found could still be known to Econt
+    under another spelling, so that's left for the remote check.
+
+    """
+    if address.get('post_code'):
+        try:
+            post_code = int(address['post_code'])
+        except (TypeError, ValueError):
+            return False, None
+        city = models.City.objects.filter(post_code=post_code).first()
+        if city is None:
+            # Nothing can be decided before the first sync
+            if models.City.objects.exists():
+                return True, CITY_NOT_FOUND
+            return False, None
+    elif address.get('city'):
+        city = models.City.objects.filter(
+            name__iexact=_city_name(address['city'])).first()
+        if city is None:
+            # Econt may still know it under another spelling
+            return False, None
+    else:
+        return False, None
+
+    parsed = address.get('address', '')
+    if isinstance(parsed, six.string_types):
+        parsed = eecont._parse_address(parsed)
+
+    streets, quarters = _city_names(city.pk)
+    street = normalize(parsed.get('street'))
+    quarter = normalize(parsed.get('quarter'))
+    if (street and street in streets) or (quarter and quarter in quarters):
+        return True, None
+    return False, None
@@ -1,15 +1,27 @@
 # -*- coding: utf-8 -*-
 
 from __future__ import unicode_literals
+import hashlib
+import itertools
 import json
+import os
+from wsgiref.util import FileWrapper
 
+from django.conf import settings
 from django.core import serializers
-from django.db.models import Count
+from django.core.cache import get_cache
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
 from django.db.models.query import QuerySet
+from django.http import Http404
 from django.http import response
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.http import parse_etags, quote_etag
 from django.views.generic import list as glist
 
+from eecont import autocomplete
+from eecont import export
 from eecont import models
+from eecont import nomenclature
 
 
 def json_response(request, serializable):
@@ -27,20 +39,108 @@ def json_response(request, serializable):
     return resp
 
 
+def _jsonp_chunks(cb, rows, chunk_size):
+    encode = json.JSONEncoder(ensure_ascii=False).encode
+    rows = iter(rows)
+    yield '{}(['.format(cb)
+    separator = ''
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if not chunk:
+            break
+        yield separator + ','.join(encode(row) for row in chunk)
+        separator = ','
+    yield ']);'
+
+
+def streaming_json_response(request, rows, chunk_size=1000):
+    """Like `json_response` but encode `rows`, an iterable, lazily in
+    chunks of `chunk_size` rows, so that the whole payload is never
+    kept in memory.
+
+    """
+    cb = request.GET.get('callback', 'callback')
+    return response.StreamingHttpResponse(
+        _jsonp_chunks(cb, rows, chunk_size),
+        content_type='application/json; charset=utf-8')
+
+
 class BaseJsonpList(glist.BaseListView):
 
     limit = 10
 
+    # Whether the results may be limited to the city given by its
+    # Econt id in the `city` or its `post_code` GET parameter
+    city_filter = False
+
+    # Without a query the whole table is listed, streamed `chunk_size`
+    # rows at a time unless `streaming` is False
+    fields = ('eid', 'name', 'name_en')
+    streaming = True
+    chunk_size = 1000
+
     def get_queryset(self):
-        qs = super(BaseJsonpList, self).get_queryset()
         query = self.request.GET.get('query')
-        if query:
-            qs = qs.filter(name__istartswith=query)\
-                   .values('name')\
-                   .annotate(count=Count('name'))[:self.limit]
-        return qs
+
+        city = None
+        eid = self.request.GET.get('city')
+        post_code = self.request.GET.get('post_code')
+        if self.city_filter and (eid or post_code):
+            city = autocomplete.city_id(eid, post_code)
+            if city is None:
+                return []
+
+        if not query:
+            qs = super(BaseJsonpList, self).get_queryset()
+            if city is not None:
+                qs = qs.filter(city_id=city)
+            return qs.values(*self.fields)
+        # Served from memory, see `eecont.autocomplete`
+        return autocomplete.search(self.model, query, self.limit, city)
 
     def get(self, request, *args, **kwargs):
+        """Respond from the caches if possible.
+
+        Responses only change with `nomenclature.version`, so they get
+        a strong ETag derived from it and conditional requests are
+        answered with 304.  `settings.EECONT['http_cache']` is a dict
+        with the optional keys:
+
+        - `max_age`: seconds clients may use a response without
+          revalidating it, 5 minutes by default.
+        - `backend`: a cache alias; if set, the responses themselves
+          are cached there too.
+        - `timeout`: seconds a cached response is kept, the backend's
+          default timeout by default.
+
+        """
+        conf = settings.EECONT.get('http_cache', {})
+        key = json.dumps([type(self).__name__, sorted(request.GET.lists()),
+                          nomenclature.version()])
+        etag = hashlib.md5(key.encode('utf-8')).hexdigest()
+
+        etags = parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))
+        if etag in etags or '*' in etags:
+            resp = response.HttpResponseNotModified()
+        else:
+            cache = get_cache(conf['backend']) if conf.get('backend') else None
+            cache_key = 'eecont:jsonp:{}'.format(etag)
+            content = cache.get(cache_key) if cache is not None else None
+            if content is None:
+                resp = self.render_jsonp(request)
+                if cache is not None and not resp.streaming:
+                    cache.set(cache_key, resp.content,
+                              conf.get('timeout', DEFAULT_TIMEOUT))
+            else:
+                resp = response.HttpResponse(
+                    content, content_type='application/json; charset=utf-8')
+
+        resp['ETag'] = quote_etag(etag)
+        patch_cache_control(resp, public=True,
+                            max_age=conf.get('max_age', 5 * 60))
+        return resp
+
+    def render_jsonp(self, request):
         self.object_list = self.get_queryset()
         allow_empty = self.get_allow_empty()
 
@@ -57,21 +157,89 @@ class BaseJsonpList(glist.BaseListView):
                 raise Http404(_("Empty list and '%(class_name)s.allow_empty' is False.")
                         % {'class_name': self.__class__.__name__})
         # context = self.get_context_data(object_list=self.object_list)
+        if self.streaming and isinstance(self.object_list, QuerySet):
+            return streaming_json_response(
+                request, self.object_list.iterator(), self.chunk_size)
         return json_response(request, self.object_list)
 
 
 class CityList(BaseJsonpList):
     model = models.City
+    fields = BaseJsonpList.fields + ('post_code',)
 
 
 class QuarterList(BaseJsonpList):
     model = models.Quarter
+    city_filter = True
 
 
 class StreetList(BaseJsonpList):
     model = models.Street
+    city_filter = True
 
 
 city_list = CityList.as_view()
 quarter_list = QuarterList.as_view()
 street_list = StreetList.as_view()
+
+
+def _codings(header):
+    """Return the set of content codings accepted by `header`, the
+    value of an Accept-Encoding header.
+
+    """
+    ret = set(['identity'])
+    for part in header.split(','):
+        coding, _, param = part.partition(';')
+        coding = coding.strip().lower()
+        param = param.strip()
+        try:
+            q = float(param[2:]) if param.startswith('q=') else 1
+        except ValueError:
+            q = 1
+        if q > 0:
+            ret.add(coding)
+        else:
+            ret.discard(coding)
+    return ret
+
+
+def dump(request, name, city=None):
+    """Serve the complete dump of `name` or, if `city` (an Econt id) is
+    given, the dump of its quarters or streets.  The dumps are built by
+    `inserter.fetch_and_insert` in `settings.EECONT['export_dir']`, see
+    `eecont.export`, and served in the best encoding the client accepts.
+
+    """
+    directory = settings.EECONT.get('export_dir')
+    version = export.current(directory) if directory else None
+    if version is None:
+        raise Http404('No nomenclature export')
+
+    accepted = _codings(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+    for ext, coding in export.ENCODINGS:
+        if coding in accepted or '*' in accepted:
+            try:
+                f = open(export.path(directory, name, city) + ext, 'rb')
+                break
+            except IOError:
+                continue
+    else:
+        raise Http404('No such export')
+
+    etag = '{}-{}'.format(version, coding)
+    if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+        f.close()
+        resp = response.HttpResponseNotModified()
+    else:
+        resp = response.StreamingHttpResponse(
+            FileWrapper(f), content_type='application/json; charset=utf-8')
+        resp['Content-Length'] = os.fstat(f.fileno()).st_size
+        if coding != 'identity':
+            resp['Content-Encoding'] = coding
+
+    resp['ETag'] = quote_etag(etag)
+    patch_vary_headers(resp, ['Accept-Encoding'])
+    patch_cache_control(resp, public=True, max_age=settings.EECONT.get(
+        'http_cache', {}).get('max_age', 5 * 60))
+    return resp